@@ -1 +1,52 @@
-from .common_bot_interfaces import *
+#%% Package attributes are loaded lazily (PEP 562), so that importing a submodule, e.g.
+#   python -m common_bot_interfaces.bot_runner
+#   from common_bot_interfaces.roles import Roles
+# does not pull in the containers and everything they use. Submodules which do not use python-telegram-bot
+# (bot_runner, roles, bot_logging, ...) then load without it. The filters do use it: importing telegram.ext
+# loads its application and HTTP stack too, so 'from common_bot_interfaces.filters import AdminFilter'
+# only saves the containers themselves, not python-telegram-bot's import time.
+# 'from common_bot_interfaces import *' and 'common_bot_interfaces.BotContainer' still work as before;
+# they load the main module on first use.
+
+import importlib
+
+_SUBMODULES = ("common_bot_interfaces", "filters", "outbound", "subprocess_runner", "metrics", "roles", "executors", "file_transfer", "state_store", "response_cache", "transport", "scheduler", "broadcast", "bot_logging", "bot_runner")
+# Names which can be served without loading the main module
+_LIGHT = {
+    "CompiledFilter": "filters",
+    "AliveFilter": "filters",
+    "AdminFilter": "filters",
+    "RoleFilter": "filters",
+    "Roles": "roles",
+    "offload": "executors",
+    "StateStore": "state_store",
+    "cached": "response_cache",
+    "PrivateOnlyChatFilter": "filters",
+    "GroupOnlyChatFilter": "filters",
+    "setupLogging": "bot_logging",
+    "stopLogging": "bot_logging",
+}
+
+def _main():
+    return importlib.import_module(".common_bot_interfaces", __name__)
+
+def __getattr__(name: str):
+    if name in _SUBMODULES:
+        return importlib.import_module("." + name, __name__)
+
+    if name == "__all__":
+        # Star imports export the public names of the main module, as they did when it was imported eagerly
+        value = [k for k in vars(_main()) if not k.startswith("_")]
+    elif name in _LIGHT:
+        value = getattr(importlib.import_module("." + _LIGHT[name], __name__), name)
+    else:
+        try:
+            value = getattr(_main(), name)
+        except AttributeError:
+            raise AttributeError("module %r has no attribute %r" % (__name__, name)) from None
+
+    globals()[name] = value # Only looked up once
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_SUBMODULES) | set(_LIGHT) | set(vars(_main())))
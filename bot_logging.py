@@ -0,0 +1,64 @@
+#%% Logging setup for the bot interfaces and the bot runner.
+# Every module in this package logs through a module-level logger, i.e. logging.getLogger(__name__),
+# and never configures handlers itself. Scripts should call setupLogging() once at startup.
+#
+# Example:
+#   from common_bot_interfaces.bot_logging import setupLogging
+#   setupLogging(logging.DEBUG) # Shows per-message filter output as well
+#
+# With queued=True, records are handed to a background thread which does the actual writing,
+# so handlers on the event loop never block on stdout.
+
+import logging
+import logging.handlers
+import queue
+import atexit
+import sys
+
+DEFAULT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+_listener = None
+
+def setupLogging(level: int=logging.INFO, queued: bool=True, fmt: str=DEFAULT_FORMAT, stream=None):
+    """
+    Configures the root logger.
+
+    Parameters
+    ----------
+    level : int
+        Logging level, e.g. logging.INFO (default) or logging.DEBUG.
+    queued : bool
+        Writes records from a background thread via a QueueHandler/QueueListener pair,
+        so logging calls only enqueue. Defaults to True.
+    fmt : str
+        Format string for the records.
+    stream : file-like
+        Output stream. Defaults to sys.stderr.
+    """
+    global _listener
+    stopLogging()
+
+    handler = logging.StreamHandler(sys.stderr if stream is None else stream)
+    handler.setFormatter(logging.Formatter(fmt))
+
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.setLevel(level)
+
+    if queued:
+        q = queue.SimpleQueue()
+        root.addHandler(logging.handlers.QueueHandler(q))
+        _listener = logging.handlers.QueueListener(q, handler, respect_handler_level=True)
+        _listener.start()
+    else:
+        root.addHandler(handler)
+
+def stopLogging():
+    """Flushes and stops the background logging thread, if one was started by setupLogging()."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+atexit.register(stopLogging)
@@ -14,43 +14,584 @@
 # 
 # Together with the GitInterface, this provides a way to continuously update the
 # core bot code and update it remotely, as it resides completely in a separate file.
+#
+# With --warm, i.e. python -m common_bot_interfaces.bot_runner --warm main_script.py arg1 arg2,
+# a standby copy of the script is kept ready (see BotContainer._waitForHandover), so /restart takes
+# effect almost immediately. Note that the standby was started with the old code, so after pulling
+# new code use '/restart cold', which starts a fresh process instead.
+#
+# Restarts asked for by the bot itself (/restart and /restart cold) exit with their own codes, RESTART_CODE (100)
+# and COLD_RESTART_CODE (101), which are restarted at once, without any backoff and without counting towards
+# the circuit breaker. Any other exit code, including 1 for an uncaught exception, is treated as a crash.
+#
+# With --config, i.e. python -m common_bot_interfaces.bot_runner --config bots.toml, many bots are supervised
+# from this one process instead (see BotSupervisor). The config file has an optional top-level statsInterval,
+# and one table per bot, where every key other than script is optional:
+#
+#   statsInterval = 60          # Seconds between CPU/memory reports; 0 disables them
+#
+#   [bots.mybot]
+#   script = "main_script.py"
+#   args = ["arg1", "arg2"]
+#   restart = "unless-shutdown" # Or "always", or "never"
+#   backoff = 1.0               # Delay before restarting a bot which crashed soon after starting; doubles each time
+#   maxBackoff = 300.0
+#   stableAfter = 60.0          # Seconds a bot must run for before its backoff is reset
+#   maxRestarts = 10            # Restarts allowed within window seconds before waiting cooldown seconds
+#   window = 600.0
+#   cooldown = 1800.0
+#   stateFile = "mybot.runner.json"
+#
+# Both the BotRunner and the BotSupervisor apply a RestartPolicy, so a script which crashes on startup is restarted
+# with an increasing delay rather than in a tight loop, and keep its restart history in a RunnerState file,
+# which StatusInterface reports on in /status.
+# CPU/memory accounting requires psutil, and is skipped if it is not installed.
 
-
-from common_bot_interfaces import *
+# Note that this only spawns the bot scripts, so it deliberately imports nothing from the interfaces
+# (and hence nothing from telegram); see __init__.py.
 
 import subprocess
+import collections
+import json
+import os
+import sys
+import time
+import asyncio
+import signal
+import logging
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+logger = logging.getLogger(__name__)
+
+class RestartPolicy:
+    """
+    Decides how long to wait before restarting a script that has exited, so that a script which crashes
+    on startup doesn't spin the CPU re-importing everything.
+
+    Scripts which exit before running for stableAfter seconds are restarted after a delay which doubles every time,
+    and if there are more than maxRestarts restarts within window seconds, the circuit breaker trips
+    and the script is left stopped for cooldown seconds (or for good, if cooldown is None).
+    """
+    def __init__(self, backoff: float=1.0, maxBackoff: float=300.0, stableAfter: float=60.0,
+                 maxRestarts: int=10, window: float=600.0, cooldown: float=1800.0):
+        """
+        Parameters
+        ----------
+        backoff : float
+            Seconds to wait before restarting a script which exited within stableAfter seconds of starting.
+            This doubles with every consecutive quick exit, up to maxBackoff.
+        maxBackoff : float
+            Upper limit on the restart delay.
+        stableAfter : float
+            Seconds a script must run for to be considered stable, which resets the delay.
+            Restarts after a stable run are immediate.
+        maxRestarts : int
+            Number of restarts allowed within the window before the circuit breaker trips. None disables the breaker.
+        window : float
+            Length in seconds of the window for maxRestarts.
+        cooldown : float
+            Seconds to wait once the breaker has tripped, after which the script is tried again.
+            None stops restarting the script altogether.
+        """
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.stableAfter = stableAfter
+        self.maxRestarts = maxRestarts
+        self.window = window
+        self.cooldown = cooldown
+
+        self.crashes = 0 # Consecutive exits before stableAfter
+        self.tripped = False # Whether the breaker tripped on the last call to nextDelay()
+        self._recent = collections.deque() # Times of restarts within the window
+
+    def seed(self, times):
+        """Adds restart times from a previous run of the runner, so that the breaker carries on where it left off."""
+        for t in sorted(times):
+            self._recent.append(t)
+
+    def nextDelay(self, runtime: float, now: float=None, requested: bool=False):
+        """
+        Records an exit after the script ran for some seconds, and returns the delay in seconds before restarting it,
+        or None if it should not be restarted. Restarts the script asked for itself (requested) are immediate,
+        and neither count as crashes nor towards the breaker.
+        """
+        self.tripped = False
+        if requested:
+            return 0.0
+
+        now = time.time() if now is None else now
+        if runtime >= self.stableAfter:
+            self.crashes = 0
+            delay = 0.0
+        else:
+            self.crashes += 1
+            delay = min(self.maxBackoff, self.backoff * 2 ** (self.crashes - 1))
+
+        if self.maxRestarts is not None:
+            self._recent.append(now)
+            while self._recent and now - self._recent[0] > self.window:
+                self._recent.popleft()
+            if len(self._recent) > self.maxRestarts:
+                self.tripped = True
+                self._recent.clear()
+                if self.cooldown is None:
+                    return None
+                delay = max(delay, self.cooldown)
+        return delay
+
+
+class RunnerState:
+    """
+    Restart history of a script, kept in a small JSON file next to it. The runner passes the path to the script
+    in the BOT_RUNNER_STATE environment variable, so that the bot can report on it (see StatusInterface).
+    """
+    HISTORY = 20
+
+    def __init__(self, path: str):
+        self.path = os.path.abspath(path)
+        self.runnerStarted = time.time()
+        self.restarts = 0 # Since this runner started
+        self.history = [] # Most recent last
+        try:
+            with open(self.path) as f:
+                self.history = json.load(f).get("history", [])[-self.HISTORY:]
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def defaultPath(script: str):
+        return os.path.splitext(script)[0] + ".runner.json"
+
+    @staticmethod
+    def describe(returncode: int):
+        if returncode == BotRunner.SHUTDOWN_CODE:
+            return "shutdown"
+        if returncode == BotRunner.RESTART_CODE:
+            return "restart"
+        if returncode == BotRunner.COLD_RESTART_CODE:
+            return "cold restart"
+        if returncode < 0:
+            try:
+                return "killed by %s" % signal.Signals(-returncode).name
+            except ValueError:
+                return "killed by signal %d" % -returncode
+        return "crash"
+
+    def record(self, returncode: int, runtime: float, restarting: bool):
+        """Adds an exit of the script to the history, and saves the file."""
+        self.history.append(dict(
+            time=time.time(),
+            returncode=returncode,
+            runtime=round(runtime, 3),
+            reason=self.describe(returncode),
+        ))
+        del self.history[:-self.HISTORY]
+        if restarting:
+            self.restarts += 1
+        self.save()
+
+    def save(self):
+        data = dict(runnerStarted=self.runnerStarted, restarts=self.restarts, history=self.history)
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path) # So the bot never reads a half-written file
+        except OSError as e:
+            logger.warning("Could not save runner state to %s: %s", self.path, e)
+
 
 class BotRunner:
+    # Exit codes of the bot; these must match BotContainer's. Restarts are never delayed, unlike crashes
     SHUTDOWN_CODE = 0
+    RESTART_CODE = 100
+    COLD_RESTART_CODE = 101 # Skips the warm standby, e.g. after the code has changed
+    STANDBY_ENV = "BOT_RUNNER_STANDBY" # Must match BotContainer.STANDBY_ENV
+    STATE_ENV = "BOT_RUNNER_STATE" # Must match StatusInterface.RUNNER_STATE_ENV
     
-    def __init__(self, script: str):
+    def __init__(self, script: str, warm: bool=False, policy: RestartPolicy=None, stateFile: str=None):
+        """
+        Parameters
+        ----------
+        script : str
+            The bot script to run.
+        warm : bool
+            Keeps a standby process of the script ready at all times, with imports done and the app built,
+            which takes over immediately when the running process exits with a restart code.
+        policy : RestartPolicy
+            Backoff and circuit breaker settings for restarts. Defaults to RestartPolicy().
+        stateFile : str
+            Where to keep the restart history. Defaults to the script's path with the extension replaced by .runner.json.
+        """
         self._script = script
+        self._warm = warm
+        self._policy = RestartPolicy() if policy is None else policy
+        self._state = RunnerState(RunnerState.defaultPath(script) if stateFile is None else stateFile)
+        self._policy.seed(entry["time"] for entry in self._state.history)
+
+    @property
+    def state(self):
+        return self._state
+
+    def _command(self, *args):
+        return " ".join(["python %s" % self._script, *args])
 
     def _run(self, *args):
         # Start a subprocess to run the script.
-        command = " ".join(["python %s" % self._script, *args])
-        print(command)
+        command = self._command(*args)
+        logger.info("%s", command)
         returncode = subprocess.call(command, shell=True)
         return returncode
 
+    def _spawn(self, *args, standby: bool=False):
+        command = self._command(*args)
+        env = None
+        if standby:
+            env = dict(os.environ)
+            env[self.STANDBY_ENV] = "1"
+            logger.info("%s (standby)", command)
+        else:
+            logger.info("%s", command)
+        return subprocess.Popen(command, shell=True, env=env, stdin=subprocess.PIPE if standby else None, text=True)
+
+    def _release(self, standby: subprocess.Popen, timeout: float=10.0):
+        # Closing its stdin without a handover tells the standby to exit
+        try:
+            standby.stdin.close()
+            standby.wait(timeout)
+        except subprocess.TimeoutExpired:
+            standby.kill()
+            standby.wait()
+
+    @classmethod
+    def requested(cls, returncode: int):
+        """Whether an exit code is a restart asked for by the bot, rather than a crash."""
+        return returncode in (cls.RESTART_CODE, cls.COLD_RESTART_CODE)
+
+    def _exited(self, returncode: int, runtime: float):
+        """Records an exit, and returns the delay before restarting, or None if the script should stay stopped."""
+        if returncode == self.SHUTDOWN_CODE:
+            logger.info("Script shutting down permanently with return code %d", returncode)
+            self._state.record(returncode, runtime, restarting=False)
+            return None
+
+        requested = self.requested(returncode)
+        delay = self._policy.nextDelay(runtime, requested=requested)
+        self._state.record(returncode, runtime, restarting=delay is not None)
+        if delay is None:
+            logger.error("Script restarted more than %d times in %.0fs, giving up (last return code %d)",
+                         self._policy.maxRestarts, self._policy.window, returncode)
+        elif self._policy.tripped:
+            logger.error("Script restarted more than %d times in %.0fs, waiting %.0fs before trying again (last return code %d)",
+                         self._policy.maxRestarts, self._policy.window, delay, returncode)
+        elif delay > 0:
+            logger.warning("Script exited with return code %d after %.1fs (%d in a row), restarting in %.1fs",
+                           returncode, runtime, self._policy.crashes, delay)
+        elif requested:
+            logger.info("Script restarting as requested (%s)", self._state.describe(returncode))
+        else:
+            logger.warning("Script stopped running temporarily with return code %d", returncode)
+        return delay
+
     def run(self, *args):
+        # Inherited by every process we start, so the bot can read its restart history
+        os.environ[self.STATE_ENV] = self._state.path
+        self._state.save()
+
+        if self._warm:
+            self._runWarm(*args)
+            return
+
         while True:
+            started = time.monotonic()
             returncode = self._run(*args)
-            if returncode == self.SHUTDOWN_CODE:
-                print("Script shutting down permanently with return code %d" % returncode)
+            delay = self._exited(returncode, time.monotonic() - started)
+            if delay is None:
                 break
+            time.sleep(delay)
 
-            else:
-                print("Script stopped running temporarily with return code %d" % returncode)
+    def _runWarm(self, *args):
+        active = self._spawn(*args)
+        started = time.monotonic()
+        standby = self._spawn(*args, standby=True)
+        try:
+            while True:
+                returncode = active.wait()
+                exitTime = time.time()
+                delay = self._exited(returncode, time.monotonic() - started)
+                if delay is None:
+                    break
+
+                if delay > 0:
+                    # Crash looping; a fresh process after the delay is more useful than a standby of the same code
+                    self._release(standby)
+                    time.sleep(delay)
+                    active = self._spawn(*args)
+                elif returncode == self.COLD_RESTART_CODE or standby.poll() is not None:
+                    if standby.poll() is not None:
+                        logger.warning("Standby exited with return code %d, starting cold", standby.returncode)
+                    self._release(standby)
+                    active = self._spawn(*args)
+                else:
+                    # The standby measures the full gap from this exit time, and logs it
+                    standby.stdin.write("%f\n" % exitTime)
+                    standby.stdin.close()
+                    logger.info("Handed over to standby in %.1fms", (time.time() - exitTime) * 1000)
+                    active = standby
+
+                started = time.monotonic()
+                standby = self._spawn(*args, standby=True)
+        finally:
+            if standby.poll() is None:
+                self._release(standby)
+
+
+#%% Supervising many bots from one process
+class SupervisedBot:
+    """Settings and running state of one bot managed by the BotSupervisor."""
+    RESTART_POLICIES = ("unless-shutdown", "always", "never")
+
+    def __init__(self, name: str, script: str, args=(), restart: str="unless-shutdown", stateFile: str=None, **policy):
+        """
+        Parameters
+        ----------
+        name : str
+            Name used in the logs.
+        script : str
+            The bot script to run.
+        args : list of str
+            Arguments for the script.
+        restart : str
+            'unless-shutdown' (the default) restarts the script unless it exits with BotRunner.SHUTDOWN_CODE,
+            'always' restarts it regardless of the exit code, and 'never' lets it stay stopped.
+        stateFile : str
+            Where to keep the restart history; see RunnerState. Defaults to the script's path with the extension
+            replaced by .runner.json, so bots sharing a script should set this.
+        **policy
+            Passed on to RestartPolicy, e.g. backoff, maxBackoff, stableAfter, maxRestarts, window and cooldown.
+        """
+        if restart not in self.RESTART_POLICIES:
+            raise ValueError("Unknown restart policy %s for %s; use one of %s." % (restart, name, ", ".join(self.RESTART_POLICIES)))
+        self.name = name
+        self.script = script
+        self.args = [str(arg) for arg in args]
+        self.restart = restart
+        self.policy = RestartPolicy(**policy)
+        self.state = RunnerState(RunnerState.defaultPath(script) if stateFile is None else stateFile)
+        self.policy.seed(entry["time"] for entry in self.state.history)
+
+        # Running state
+        self.proc = None
+        self.starts = 0
+        self.cpuSeconds = 0.0 # Total CPU time of all previous runs
+        self._lastCpu = 0.0 # CPU time of the current run, as of the last sample
+
+    def command(self):
+        return " ".join(["python %s" % self.script, *self.args])
+
+    def shouldRestart(self, returncode: int):
+        if self.restart == "never":
+            return False
+        if self.restart == "unless-shutdown":
+            return returncode != BotRunner.SHUTDOWN_CODE
+        return True
+
+    def sample(self):
+        """
+        Returns (total CPU seconds, RSS bytes) for the running script and all its children,
+        or None if it is not running or psutil is not available.
+        """
+        if psutil is None or self.proc is None or self.proc.returncode is not None:
+            return None
+        try:
+            root = psutil.Process(self.proc.pid)
+            procs = [root, *root.children(recursive=True)]
+        except psutil.NoSuchProcess:
+            return None
+
+        cpu = 0.0
+        rss = 0
+        for p in procs:
+            try:
+                times = p.cpu_times()
+                cpu += times.user + times.system
+                rss += p.memory_info().rss
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                pass
+        self._lastCpu = cpu
+        return cpu, rss
+
+    def exited(self):
+        # The last sample is the best we have; the process is gone by now
+        self.cpuSeconds += self._lastCpu
+        self._lastCpu = 0.0
+
+
+class BotSupervisor:
+    """
+    Runs many bot scripts concurrently from one process, restarting each one according to its own policy.
+    Unlike the BotRunner, this never blocks on a single script; every bot is a task on one asyncio loop.
+    """
+    def __init__(self, bots: list, statsInterval: float=60.0):
+        """
+        Parameters
+        ----------
+        bots : list of SupervisedBot
+            The bots to run. Names must be unique.
+        statsInterval : float
+            Seconds between logging the CPU and memory use of each bot. 0 or None disables this.
+        """
+        names = [bot.name for bot in bots]
+        if len(set(names)) != len(names):
+            raise ValueError("Bot names must be unique.")
+        self._bots = list(bots)
+        self._statsInterval = statsInterval
+        self._stopping = False
+        self._stopped = None # Event set by stop(), made on the supervisor's loop
+
+    @property
+    def bots(self):
+        return self._bots
 
+    @classmethod
+    def fromConfig(cls, path: str):
+        """Creates a supervisor from a TOML config file; see the top of this file for the format."""
+        try:
+            import tomllib
+        except ImportError: # Python < 3.11
+            import tomli as tomllib
 
+        with open(path, "rb") as f:
+            config = tomllib.load(f)
+
+        bots = [SupervisedBot(name, **settings) for name, settings in config.get("bots", dict()).items()]
+        if len(bots) == 0:
+            raise ValueError("No bots found in %s." % path)
+        return cls(bots, statsInterval=config.get("statsInterval", 60.0))
+
+    def run(self):
+        asyncio.run(self._main())
+
+    async def _main(self):
+        loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        if self._stopping:
+            self._stopped.set()
+        if os.name == 'posix':
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, self.stop)
+
+        if self._statsInterval and psutil is None:
+            logger.warning("psutil is not installed; per-bot CPU/memory accounting is disabled")
+
+        stats = None
+        if self._statsInterval and psutil is not None:
+            stats = loop.create_task(self._reportStats())
+        try:
+            await asyncio.gather(*(self._supervise(bot) for bot in self._bots))
+        finally:
+            if stats is not None:
+                stats.cancel()
+        logger.info("All bots have stopped")
+
+    def stop(self):
+        """Stops restarting bots, and terminates the ones that are running."""
+        if not self._stopping:
+            logger.info("Stopping all bots..")
+        self._stopping = True
+        if self._stopped is not None:
+            self._stopped.set() # Wakes up the bots waiting to be restarted
+        for bot in self._bots:
+            if bot.proc is not None and bot.proc.returncode is None:
+                bot.proc.terminate()
+
+    async def _supervise(self, bot: SupervisedBot):
+        loop = asyncio.get_running_loop()
+        env = dict(os.environ)
+        env[BotRunner.STATE_ENV] = bot.state.path
+        bot.state.save()
+        while not self._stopping:
+            command = bot.command()
+            logger.info("[%s] %s", bot.name, command)
+            started = loop.time()
+            bot.proc = await asyncio.create_subprocess_shell(command, env=env)
+            bot.starts += 1
+            returncode = await bot.proc.wait()
+            bot.exited()
+            runtime = loop.time() - started
+
+            if self._stopping:
+                bot.state.record(returncode, runtime, restarting=False)
+                break
+            if not bot.shouldRestart(returncode):
+                logger.info("[%s] Script stopped permanently with return code %d", bot.name, returncode)
+                bot.state.record(returncode, runtime, restarting=False)
+                break
+
+            requested = BotRunner.requested(returncode)
+            delay = bot.policy.nextDelay(runtime, requested=requested)
+            bot.state.record(returncode, runtime, restarting=delay is not None)
+            if delay is None:
+                logger.error("[%s] Script restarted more than %d times in %.0fs, giving up (last return code %d)",
+                             bot.name, bot.policy.maxRestarts, bot.policy.window, returncode)
+                break
+            if bot.policy.tripped:
+                logger.error("[%s] Script restarted more than %d times in %.0fs, waiting %.0fs before trying again (last return code %d)",
+                             bot.name, bot.policy.maxRestarts, bot.policy.window, delay, returncode)
+            elif delay > 0:
+                logger.warning("[%s] Script exited with return code %d after %.1fs (%d in a row), restarting in %.1fs",
+                               bot.name, returncode, runtime, bot.policy.crashes, delay)
+            elif requested:
+                logger.info("[%s] Script restarting as requested (%s)", bot.name, bot.state.describe(returncode))
+            else:
+                logger.warning("[%s] Script stopped running temporarily with return code %d", bot.name, returncode)
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._stopped.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _reportStats(self):
+        previous = dict()
+        while True:
+            await asyncio.sleep(self._statsInterval)
+            for bot in self._bots:
+                sample = bot.sample()
+                if sample is None:
+                    previous.pop(bot.name, None)
+                    continue
+                cpu, rss = sample
+                last = previous.get(bot.name)
+                # Percentage over the interval, if the same run was sampled last time
+                percent = 100.0 * (cpu - last[1]) / self._statsInterval if last is not None and last[0] == bot.starts else 0.0
+                previous[bot.name] = (bot.starts, cpu)
+                logger.info("[%s] pid %d: CPU %.1f%%, total %.1fs; RSS %.1fMB; started %d time(s)",
+                            bot.name, bot.proc.pid, percent, bot.cpuSeconds + cpu, rss / 1048576, bot.starts)
 
 
 if __name__ == "__main__":
-    import sys
-    if len(sys.argv) < 2:
-        print("Run this as a module, e.g. python -m common_bot_interfaces.bot_runner main_script.py arg1 arg2")
+    from common_bot_interfaces.bot_logging import setupLogging
+    setupLogging()
+    argv = sys.argv[1:]
+    if len(argv) > 0 and argv[0] == "--config":
+        if len(argv) != 2:
+            print("Usage: python -m common_bot_interfaces.bot_runner --config bots.toml")
+            sys.exit(1)
+        BotSupervisor.fromConfig(argv[1]).run()
+        sys.exit(0)
+
+    warm = len(argv) > 0 and argv[0] == "--warm"
+    if warm:
+        argv = argv[1:]
+    if len(argv) < 1:
+        print("Run this as a module, e.g. python -m common_bot_interfaces.bot_runner [--warm] main_script.py arg1 arg2")
+        print("or python -m common_bot_interfaces.bot_runner --config bots.toml")
+        sys.exit(1)
 
-    runner = BotRunner(sys.argv[1])
+    runner = BotRunner(argv[0], warm=warm)
 
-    runner.run(*sys.argv[2:])
\ No newline at end of file
+    runner.run(*argv[1:])
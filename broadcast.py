@@ -0,0 +1,221 @@
+#%% Fan-out of one message to many chats, used by the BroadcastInterface.
+# Messages go through the bot's OutboundQueue at low priority, so a broadcast:
+#   - keeps to Telegram's global and per-chat rate limits, and waits out 429s for the retry-after the server gives,
+#   - never holds up replies to commands, which are sent first,
+#   - has at most 'concurrency' of its messages queued or in flight at once, so the queue stays short.
+# Chats which can't be sent to (e.g. they blocked the bot) are counted as failed, and skipped.
+#
+# Given a StateStore, progress is checkpointed as it goes, and an unfinished broadcast is resumed when the bot starts
+# again. Messages which were in flight when the bot stopped may be sent again after a restart, so a chat may
+# (rarely) get the message twice, but never miss it.
+
+import asyncio
+import time
+import logging
+
+try:
+    from .outbound import PRIORITY_LOW
+except ImportError: # Running from the same folder as a script
+    from outbound import PRIORITY_LOW
+
+logger = logging.getLogger(__name__)
+
+class Broadcast:
+    """One message to a list of chats, and its progress."""
+    def __init__(self, chats: list, text: str, kwargs: dict=None, notifyChat: int=None,
+                 next: int=0, sent: int=0, failed: int=0, started: float=None):
+        self.chats = chats
+        self.text = text
+        self.kwargs = dict() if kwargs is None else kwargs
+        self.notifyChat = notifyChat # Told when the broadcast finishes
+        self.next = next # Every chat before this index is done
+        self.sent = sent
+        self.failed = failed
+        self.started = time.time() if started is None else started
+        self.finished = None
+        self.cancelled = False
+        self._resumedAt = time.time()
+        self._doneSinceResume = 0
+
+    @property
+    def total(self):
+        return len(self.chats)
+
+    @property
+    def done(self):
+        return self.sent + self.failed
+
+    @property
+    def rate(self):
+        """Messages per second since the broadcast (re)started in this process."""
+        elapsed = (self.finished or time.time()) - self._resumedAt
+        return self._doneSinceResume / elapsed if elapsed > 0 else 0.0
+
+    def progress(self):
+        """Dictionary of the checkpointed progress; the chats and the text are saved separately, once."""
+        return dict(next=self.next, sent=self.sent, failed=self.failed, started=self.started, notifyChat=self.notifyChat)
+
+    def report(self):
+        text = "Broadcast to %d chat(s): %d sent, %d failed (%.0f%%), %.1f msg/s" % (
+            self.total, self.sent, self.failed, self.done / self.total * 100 if self.total else 100.0, self.rate)
+        if self.cancelled:
+            text += ", cancelled"
+        elif self.finished is not None:
+            text += ", finished in %.0fs" % (self.finished - self.started)
+        elif self.rate > 0:
+            text += ", about %.0fs to go" % ((self.total - self.done) / self.rate)
+        return text
+
+
+class Broadcaster:
+    """Runs one broadcast at a time through an OutboundQueue, checkpointing its progress to a StateStore."""
+    def __init__(self, outbox, store=None, namespace: str="broadcast", concurrency: int=20, checkpointInterval: float=1.0):
+        """
+        Parameters
+        ----------
+        outbox : OutboundQueue
+            The bot's queue, which the messages are sent through.
+        store : StateStore
+            Where progress is checkpointed. Defaults to None, for no checkpoints (and no resuming).
+        namespace : str
+            Namespace of the checkpoint in the store.
+        concurrency : int
+            Maximum number of the broadcast's messages queued or in flight at once.
+        checkpointInterval : float
+            Minimum seconds between checkpoints.
+        """
+        self._outbox = outbox
+        self._store = store
+        self._namespace = namespace
+        self._concurrency = concurrency
+        self._checkpointInterval = checkpointInterval
+        self._lastCheckpoint = 0.0
+        self._broadcast = None
+        self._task = None
+        self.onFinished = None # Optional async callback, given the Broadcast when it finishes
+
+    @property
+    def current(self):
+        """The running broadcast, or the last one, or None."""
+        return self._broadcast
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self, chats: list, text: str, notifyChat: int=None, **kwargs):
+        """
+        Starts sending a message to a list of chat IDs, and returns its Broadcast.
+        Keyword arguments are passed on to bot.send_message(), e.g. parse_mode. Must be called from the event loop.
+        """
+        if self.running:
+            raise RuntimeError("A broadcast is already running; cancel it first.")
+        broadcast = Broadcast(list(dict.fromkeys(chats)), text, kwargs, notifyChat) # Without duplicates, in order
+        if self._store is not None:
+            self._store.set(0, "broadcast", dict(chats=broadcast.chats, text=text, kwargs=kwargs), namespace=self._namespace)
+        self._launch(broadcast)
+        self._checkpoint(force=True) # Replacing the progress of any earlier broadcast
+        return broadcast
+
+    async def resume(self):
+        """Resumes the broadcast checkpointed in the store, if it did not finish. Returns it, or None."""
+        if self._store is None or self.running:
+            return None
+        saved = await self._store.get(0, "broadcast", namespace=self._namespace)
+        progress = await self._store.get(0, "progress", namespace=self._namespace)
+        if saved is None:
+            return None
+        progress = dict() if progress is None else progress
+        broadcast = Broadcast(saved["chats"], saved["text"], saved["kwargs"], **progress)
+        if broadcast.next >= broadcast.total:
+            return None
+        logger.info("Resuming broadcast to %d chat(s) from %d", broadcast.total, broadcast.next)
+        self._launch(broadcast)
+        return broadcast
+
+    async def cancel(self):
+        """Stops the running broadcast for good. Messages already queued are still sent."""
+        if not self.running:
+            return None
+        self._broadcast.cancelled = True
+        await self.stop()
+        self._forget()
+        return self._broadcast
+
+    async def stop(self):
+        """Stops the running broadcast, keeping its checkpoint so that it is resumed at the next start."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        if not self._broadcast.cancelled and self._broadcast.finished is None:
+            self._checkpoint(force=True)
+
+    def _launch(self, broadcast: Broadcast):
+        self._broadcast = broadcast
+        self._lastCheckpoint = 0.0
+        self._task = asyncio.get_running_loop().create_task(self._run(broadcast), name="Broadcaster")
+
+    def _checkpoint(self, force: bool=False):
+        now = time.time()
+        if self._store is None or (not force and now - self._lastCheckpoint < self._checkpointInterval):
+            return
+        self._lastCheckpoint = now
+        self._store.set(0, "progress", self._broadcast.progress(), namespace=self._namespace)
+
+    def _forget(self):
+        if self._store is not None:
+            self._store.delete(0, "broadcast", namespace=self._namespace)
+            self._store.delete(0, "progress", namespace=self._namespace)
+
+    async def _run(self, broadcast: Broadcast):
+        slots = asyncio.Semaphore(self._concurrency)
+        completed = set() # Indices done, beyond broadcast.next
+        sends = set()
+
+        async def send(i: int):
+            try:
+                await self._outbox.send(broadcast.chats[i], broadcast.text, priority=PRIORITY_LOW, logFailures=False, **broadcast.kwargs)
+                broadcast.sent += 1
+            except Exception as e:
+                # Retries on flood limits are done by the queue, so these are e.g. chats which blocked the bot
+                logger.debug("Broadcast to %s failed: %r", broadcast.chats[i], e)
+                broadcast.failed += 1
+            broadcast._doneSinceResume += 1
+            completed.add(i)
+            while broadcast.next in completed:
+                completed.discard(broadcast.next)
+                broadcast.next += 1
+            self._checkpoint()
+            slots.release()
+
+        try:
+            for i in range(broadcast.next, broadcast.total):
+                await slots.acquire()
+                task = asyncio.get_running_loop().create_task(send(i))
+                sends.add(task)
+                task.add_done_callback(sends.discard)
+            if sends:
+                await asyncio.gather(*sends)
+        except asyncio.CancelledError:
+            for task in sends:
+                task.cancel()
+            raise
+
+        broadcast.finished = time.time()
+        self._forget()
+        logger.info(broadcast.report())
+        if self.onFinished is not None:
+            try:
+                await self.onFinished(broadcast)
+            except Exception:
+                logger.exception("Broadcast finished callback failed")
+
+    def report(self):
+        if self._broadcast is None:
+            return "No broadcast has been sent."
+        return self._broadcast.report()
@@ -1,10 +1,48 @@
-from telegram.ext import Application, ApplicationBuilder, ContextTypes, CommandHandler
-from telegram.ext.filters import MessageFilter, Regex
+from telegram.ext import Application, ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, BaseHandler, BaseUpdateProcessor
+from telegram.ext.filters import Regex, Document as DocumentFilter
 from telegram import Update, constants, helpers
 import os
+import sys
+import json
+import importlib
+import importlib.util
+import time
+import asyncio
+import threading
 import datetime as dt
-from functools import reduce
-import subprocess
+import logging
+import httpx
+
+try:
+    from .subprocess_runner import SubprocessRunner
+    from .outbound import OutboundQueue, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+    from .filters import CompiledFilter, recordOf, AliveFilter, AdminFilter, RoleFilter, PrivateOnlyChatFilter, GroupOnlyChatFilter
+    from .roles import Roles, ROLES, ROLE_ADMIN, ROLE_OPERATOR, ROLE_READONLY
+    from .executors import executors, offload, THREAD, PROCESS
+    from .file_transfer import FileTransfer, FileTooLarge, TransferFailed
+    from .state_store import StateStore
+    from .response_cache import cached, invalidate
+    from .metrics import Metrics, MetricsServer, currentCommand, STAGE_FILTER, STAGE_HANDLER
+    from .transport import Transport
+    from .scheduler import Scheduler
+    from .broadcast import Broadcaster
+    from .bot_logging import stopLogging
+except ImportError: # Running this file directly as a script
+    from subprocess_runner import SubprocessRunner
+    from outbound import OutboundQueue, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+    from filters import CompiledFilter, recordOf, AliveFilter, AdminFilter, RoleFilter, PrivateOnlyChatFilter, GroupOnlyChatFilter
+    from roles import Roles, ROLES, ROLE_ADMIN, ROLE_OPERATOR, ROLE_READONLY
+    from executors import executors, offload, THREAD, PROCESS
+    from file_transfer import FileTransfer, FileTooLarge, TransferFailed
+    from state_store import StateStore
+    from response_cache import cached, invalidate
+    from metrics import Metrics, MetricsServer, currentCommand, STAGE_FILTER, STAGE_HANDLER
+    from transport import Transport
+    from scheduler import Scheduler
+    from broadcast import Broadcaster
+    from bot_logging import stopLogging
+
+logger = logging.getLogger(__name__)
 
 #%% This is the base container. Every bot should inherit from this, and this must be included at the end after all mixins.
 # Important: Many, if not all mixins, will assume that the stuff in this class exist. For example, universal filters may be applied to every handler added.
@@ -12,20 +50,56 @@ import subprocess
 # This means that all mixin interfaces must abide by a few rules:
 # The first is the _addInterfaceHandlers() method. All mixins must implement this method, and should always call super()._addInterfaceHandlers(),
 # so that all other mixins will be able to add their own handlers.
+# Commands should be registered with self.addCommand() rather than added to the app directly, so that they go through the command router.
 # The second is that the universal filters is appended to after super().__init__() in the individual init methods. Mixin individual
 # handlers can choose whether to use the universal set of filters in their handler methods.
 class BotContainer:
+    # Set by the BotRunner (in warm mode) for the pre-spawned standby process; must match BotRunner.STANDBY_ENV
+    STANDBY_ENV = "BOT_RUNNER_STANDBY"
+    # Exit codes for exitAfterDrain(); must match BotRunner.SHUTDOWN_CODE, RESTART_CODE and COLD_RESTART_CODE.
+    # Restarts with these are never delayed by the runner, unlike exits with any other code, which it treats as crashes
+    SHUTDOWN_CODE = 0
+    RESTART_CODE = 100
+    COLD_RESTART_CODE = 101
+
     def __init__(self, app: Application):
         '''Basic container with the app as a member variable.'''
         self._app = app
-        print(self._app)
-        # Create the universal filters
+        logger.debug("%s", self._app)
+        # Create the universal filters; these are compiled into a single filter by freezeFilters() at run()
         self._ufilts = []
+        self._compiledUfilts = None
+        # All commands are dispatched through a single router handler, created on the first addCommand()
+        self._router = None
+        # Other handlers added with addHandler(), as (handler, group), which reloadHandlers() replaces
+        self._handlers = []
+        self._reloading = False
+        # Modification times of the modules which reloadHandlers() may reload, taken at run()
+        self._moduleMtimes = dict()
+        # Set by exitAfterDrain(); see _drain()
+        self._exitCode = None
+        self._drainStarted = None
+        self._drainDeadline = None
+        self._drainTimer = None
+        self.drainStats = None # Seconds taken by each phase of the last drain
+        # Shared engine for running external commands without blocking the event loop
+        self._subprocs = SubprocessRunner()
+        # Timings of every command, filled in by the router and the outbound queue
+        self._metrics = Metrics()
+        self._metricsServer = None
+        # Thread and process pools for blocking and CPU-heavy work; see executors.py
+        self._executors = executors
+        # Persistent per-chat state, opened on first use; see state
+        self._stateStore = None
+        # Rate-limited queue for all replies; see reply()
+        self._outbox = OutboundQueue(self._app.bot, metrics=self._metrics)
         # Add all handlers
-        print("Bot has initialised.")
+        logger.info("Bot has initialised.")
 
         # Placeholders
         self.botname = None
+        self.handoverGap = None # Seconds between the previous process exiting and this one taking over, if started as a standby
+        self.skipStaleUpdates = False # Drops updates which are pending at startup; see run()
 
     def link(self, start: str=None):
         """
@@ -36,126 +110,810 @@ class BotContainer:
     def setBotname(self, botname: str):
         self.botname = botname
 
+    @property
+    def subprocs(self):
+        return self._subprocs
+
+    @property
+    def outbox(self):
+        return self._outbox
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    @property
+    def executors(self):
+        return self._executors
+
+    @property
+    def state(self):
+        """
+        Persistent key-value state per chat, shared by all the mixins; see state_store.py.
+        Unless set with setStateStore(), this is kept next to the main script, in <script>.state.sqlite.
+        """
+        if self._stateStore is None:
+            self._stateStore = StateStore(os.path.splitext(os.path.abspath(sys.argv[0]))[0] + ".state.sqlite")
+        return self._stateStore
+
+    def invalidateCache(self, group: str=None):
+        """Drops results cached by methods decorated with @cached (see response_cache.py), for one group or all of them."""
+        return invalidate(self, group)
+
+    def setStateStore(self, path: str, **kwargs):
+        """Keeps the state in a given SQLite file. Keyword arguments are passed on to StateStore."""
+        self._stateStore = StateStore(path, **kwargs)
+
+    def serveMetrics(self, port: int=9464, host: str="127.0.0.1"):
+        """Serves the command metrics in the Prometheus text format over HTTP while the bot runs. Call before run()."""
+        self._metricsServer = MetricsServer(self._metrics, host, port)
+
+    async def reply(self, update, text: str, priority: int=PRIORITY_NORMAL, wait: bool=False, **kwargs):
+        """
+        Queues a message for sending through the container's rate-limited outbound queue.
+        Interfaces should use this rather than calling context.bot.send_message() directly.
+
+        Parameters
+        ----------
+        update : Update or int
+            The update to reply to (the message goes to its chat), or a chat ID.
+        text : str
+            The message text.
+        priority : int
+            PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW. Admin and control replies should use PRIORITY_HIGH.
+        wait : bool
+            Waits for the message to actually be sent and returns the sent Message.
+            Otherwise returns immediately with a future for it.
+        **kwargs
+            Passed on to bot.send_message(), e.g. parse_mode.
+        """
+        chatId = update.effective_chat.id if isinstance(update, Update) else update
+        future = self._outbox.send(chatId, text, priority=priority, **kwargs)
+        if wait:
+            return await future
+        return future
+
     @property
     def ufilts(self):
-        return reduce(lambda x, y: x & y, self._ufilts)
+        """
+        The universal filters, combined into a single filter.
+        Once frozen (see freezeFilters()), this is the same shared CompiledFilter instance on every access.
+        """
+        if self._compiledUfilts is not None:
+            return self._compiledUfilts
+        return CompiledFilter(self._ufilts)
+
+    def freezeFilters(self, cacheResults: bool=True):
+        """
+        Compiles the universal filters into one flat, shared filter.
+        This is called at run(), before any interface handlers are added, after which
+        no further universal filters may be appended.
+
+        Parameters
+        ----------
+        cacheResults : bool
+            Caches the result for the last update seen, so that the universal filters
+            are evaluated once per update rather than once per handler. Defaults to True.
+        """
+        if self._compiledUfilts is None:
+            self._ufilts = tuple(self._ufilts)
+            self._compiledUfilts = CompiledFilter(self._ufilts, cacheResults=cacheResults)
+        return self._compiledUfilts
+
+    def addCommand(self, command, callback, filters=None, **kwargs):
+        """
+        Registers a command with the container's command router, instead of adding a separate
+        CommandHandler to the application. Arguments are the same as for CommandHandler.
+
+        The router is installed into the application (group 0) on the first call, and looks up
+        commands by name in a dictionary, so dispatch cost does not grow with the number of commands.
+        Handlers registered for the same command are tried in the order they were added,
+        so fallbacks (e.g. /start without a payload) must be added last.
+        """
+        if self._router is None:
+            self._router = CommandRouter(self._metrics)
+            self._app.add_handler(self._router)
+        handler = CommandHandler(command, callback, filters=filters, **kwargs)
+        self._router.add(handler)
+        return handler
+
+    def addHandler(self, handler: BaseHandler, group: int=0):
+        """
+        Adds a handler which is not a command (e.g. a MessageHandler for documents) to the application.
+        Unlike handlers added to the application directly, these are replaced with the new code by reloadHandlers().
+        """
+        self._handlers.append((handler, group))
+        if not self._reloading:
+            self._app.add_handler(handler, group)
+        return handler
 
     def _addInterfaceHandlers(self):
-        print("BotContainer passthrough.")
+        logger.debug("BotContainer passthrough.")
         pass
 
-    def run(self):
+    def run(self, mode: str="polling", **kwargs):
+        """
+        Adds all the interface handlers and then starts the bot.
+
+        Parameters
+        ----------
+        mode : str
+            Either 'polling' (the default), which long-polls Telegram for updates,
+            or 'webhook', which serves updates over a local HTTP listener instead.
+            Webhook mode requires the 'webhooks' extra of python-telegram-bot, and is meant
+            to sit behind a reverse proxy which terminates TLS, so it listens on 127.0.0.1 by default,
+            and webhook_url (the public HTTPS URL of the proxy) must be given.
+        **kwargs
+            Passed on to Application.run_polling() or Application.run_webhook() respectively,
+            e.g. port, url_path, webhook_url and secret_token for webhooks.
+            drop_pending_updates defaults to skipStaleUpdates, so that (e.g. with StatusInterface) the backlog
+            which built up while the bot was down is discarded by Telegram, instead of being fetched and filtered.
+        """
+        if mode not in ("polling", "webhook"):
+            raise ValueError("Unknown run mode %s; use 'polling' or 'webhook'." % mode)
+        if mode == "webhook" and not kwargs.get("webhook_url"):
+            # Otherwise the local listener's address would be registered with Telegram, which rejects it
+            raise ValueError("Webhook mode needs the public webhook_url that Telegram should send updates to.")
+
         # We add the interface handlers before running as this allows us to fill in filters without worrying about order
-        print("Adding handlers..")
+        self.freezeFilters()
+        logger.info("Adding handlers..")
         self._addInterfaceHandlers()
+        self._moduleMtimes = {module.__name__: os.path.getmtime(module.__file__) for module in self._reloadableModules()}
+
+        if os.environ.pop(self.STANDBY_ENV, None):
+            self._waitForHandover()
+
+        postInit = self._app.post_init
+        async def startServices(app):
+            if postInit is not None:
+                await postInit(app)
+            if self._metricsServer is not None:
+                await self._metricsServer.start()
+            await self._onStart()
+        self._app.post_init = startServices
+
+        # Runs after the application has stopped taking updates and finished its handlers, but before the bot is shut down
+        postStop = self._app.post_stop
+        async def drainOnStop(app):
+            if postStop is not None:
+                await postStop(app)
+            if self._metricsServer is not None:
+                await self._metricsServer.stop()
+            await self._drain()
+            await self._onStop()
+        self._app.post_stop = drainOnStop
 
-        print("Running..")
-        self._app.run_polling()
+        kwargs.setdefault("drop_pending_updates", self.skipStaleUpdates)
+        if mode == "webhook":
+            kwargs.setdefault("listen", "127.0.0.1")
+            kwargs.setdefault("port", 8443)
+            logger.info("Running webhook on %s:%d..", kwargs["listen"], kwargs["port"])
+            self._app.run_webhook(**kwargs)
+        else:
+            logger.info("Running..")
+            self._app.run_polling(**kwargs)
+
+        if self._exitCode is not None:
+            self._drainTimer.cancel()
+            self.drainStats["total"] = time.perf_counter() - self._drainStarted
+            logger.info("Drained in %.3fs (%s), exiting with code %d",
+                        self.drainStats["total"], ", ".join("%s %.3fs" % kv for kv in self.drainStats.items() if kv[0] != "total"), self._exitCode)
+            sys.exit(self._exitCode)
+
+    def exitAfterDrain(self, code: int, deadline: float=30.0, grace: float=5.0):
+        """
+        Stops the bot gracefully, and then exits with the given code for the BotRunner.
+
+        New updates stop being fetched at once, and work queued for the executors which has not started is cancelled,
+        so that handlers waiting on it return. The application then waits for the handlers in flight, including
+        commands they are running, and the updates which were handled are confirmed with Telegram, so the next process
+        does not fetch them again. After that, queued replies are sent (see _drain()).
+        Commands still running grace seconds before the deadline are asked to exit (SIGTERM). If all this takes longer
+        than the deadline in seconds, whatever is left is killed and the process exits with the code anyway.
+        This may be called from within a handler, which should return soon after.
+        """
+        if self._exitCode is not None:
+            return
+        logger.info("Draining before exiting with code %d..", code)
+        self._executors.shutdown()
+        # The application only stops once every handler has returned, so a handler waiting on a command would hold it up
+        asyncio.get_running_loop().call_later(max(0.0, deadline - grace), self._terminateCommands)
+        self._exitCode = code
+        self._drainStarted = time.perf_counter()
+        self._drainDeadline = self._drainStarted + deadline
+        self.drainStats = dict()
+        self._drainTimer = threading.Timer(deadline, self._forceExit)
+        self._drainTimer.daemon = True
+        self._drainTimer.start()
+        self._app.stop_running()
+
+    def _terminateCommands(self):
+        terminated = self._subprocs.terminateAll()
+        if terminated > 0:
+            logger.warning("Asked %d command(s) still running to exit", terminated)
+
+    def _forceExit(self):
+        logger.error("Drain did not finish within its deadline, exiting with code %d anyway", self._exitCode)
+        # Commands run in their own sessions, and process pool workers in their own processes, so they would outlive us
+        self._subprocs.cancelAll()
+        self._executors.shutdown(kill=True)
+        # The queued logging thread first, or the records above may never be written
+        stopLogging()
+        logging.shutdown()
+        os._exit(self._exitCode)
+
+    async def _drain(self):
+        if self._exitCode is None:
+            return
+        t = time.perf_counter()
+        self.drainStats["handlers"] = t - self._drainStarted
+
+        # Anything started by the handlers which were still running when exitAfterDrain() was called
+        self._terminateCommands()
+        self._executors.shutdown()
+
+        try:
+            await asyncio.wait_for(self._outbox.join(), max(0.0, self._drainDeadline - time.perf_counter()))
+        except asyncio.TimeoutError:
+            logger.warning("Gave up on %d unsent message(s)", self._outbox.pending)
+        await self._outbox.stop()
+        self.drainStats["sends"] = time.perf_counter() - t
+
+    def _waitForHandover(self):
+        """
+        Used when this process was pre-spawned as a warm standby by the BotRunner.
+        Everything up to polling is done in advance (imports, handlers, app initialisation), and then we block
+        until the runner writes the exit time of the previous process to our stdin.
+        """
+        # run_polling()/run_webhook() pick up this loop, and skip initialisation as it's already done
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(self._app.initialize())
+
+        logger.info("Standby ready, waiting for handover..")
+        line = sys.stdin.readline()
+        if not line:
+            logger.info("Standby released by the runner without a handover.")
+            loop.run_until_complete(self._app.shutdown())
+            sys.exit(0)
+
+        self.handoverGap = time.time() - float(line)
+        logger.info("Took over %.3fs after the previous process exited.", self.handoverGap)
+        self._onHandover()
+
+    def _reloadableModules(self):
+        """
+        Modules defining the bot's classes which can be reloaded, base classes first.
+        This excludes __main__, which cannot be re-imported, and this package itself, whose objects (e.g. the router
+        and the outbound queue) are already live; changes to either still need a restart.
+        """
+        here = os.path.dirname(os.path.abspath(__file__))
+        modules = []
+        for cls in reversed(type(self).__mro__):
+            module = sys.modules.get(cls.__module__)
+            if (
+                module is None
+                or module.__name__ == "__main__"
+                or getattr(module, "__file__", None) is None
+                or os.path.dirname(os.path.abspath(module.__file__)) == here
+                or module in modules
+            ):
+                continue
+            modules.append(module)
+        return modules
+
+    def reloadHandlers(self):
+        """
+        Re-imports the bot's handler modules which have changed on disk, points the bot's classes at the new code,
+        and rebuilds the command table by calling _addInterfaceHandlers() again. The new table replaces the old one
+        in a single assignment, so every update is handled entirely by either the old or the new handlers,
+        and polling carries on throughout.
+
+        Only commands registered with addCommand(), and handlers added with addHandler(), are replaced. State is kept as is, since __init__ is not called again,
+        so new attributes must be given class-level defaults. Returns the names of the modules which were reloaded.
+        If a module fails to import, the exception is raised and the old handlers stay in place; every changed module,
+        including those which did import, is then reloaded again by the next call.
+        """
+        changed = []
+        for module in self._reloadableModules():
+            mtime = os.path.getmtime(module.__file__)
+            if mtime != self._moduleMtimes.get(module.__name__):
+                changed.append((module, mtime))
+        if len(changed) == 0:
+            return []
+
+        for module, mtime in changed:
+            logger.info("Reloading %s", module.__name__)
+            # The cached bytecode is only checked against the source's size and mtime in whole seconds, which a quick edit can fool
+            try:
+                os.remove(importlib.util.cache_from_source(module.__file__))
+            except (OSError, ValueError, NotImplementedError):
+                pass
+            importlib.reload(module)
+
+        reloaded = {module.__name__ for module, _ in changed}
+        self.__class__ = self._rebase(type(self), reloaded)
+
+        # Build a new table without installing it; addCommand() only installs a router when there is none
+        live = self._router
+        liveHandlers, self._handlers = self._handlers, []
+        directHandlers = {group: list(handlers) for group, handlers in self._app.handlers.items()}
+        self._router = CommandRouter(self._metrics)
+        self._reloading = True
+        try:
+            self._addInterfaceHandlers()
+        except Exception:
+            self._handlers = liveHandlers
+            raise
+        finally:
+            self._reloading = False
+            table = self._router.table
+            self._router = live
+            # Handlers added to the app directly would be duplicated; those need a restart to change
+            for group, handlers in list(self._app.handlers.items()):
+                for handler in handlers[len(directHandlers.get(group, [])):]:
+                    logger.warning("Not reloading %s added directly to the app; use addCommand() or addHandler() instead", handler)
+                    self._app.remove_handler(handler, group)
+        live.replaceTable(table)
+        # Replaced in one go, without awaiting in between
+        for handler, group in liveHandlers:
+            self._app.remove_handler(handler, group)
+        for handler, group in self._handlers:
+            self._app.add_handler(handler, group)
+        # Only now, so that after a failure anywhere above, the whole batch is reloaded and rebased again
+        for module, mtime in changed:
+            self._moduleMtimes[module.__name__] = mtime
+        return sorted(reloaded)
+
+    @classmethod
+    def _rebase(cls, klass: type, reloaded: set):
+        """
+        Returns the reloaded version of a class, if its module was reloaded. Otherwise its bases are rebased in place,
+        which (unlike creating a new class) keeps the zero-argument super() calls in its methods working.
+        """
+        if klass.__module__ in reloaded:
+            new = getattr(sys.modules[klass.__module__], klass.__name__, None)
+            if isinstance(new, type):
+                return new
+        if klass is object:
+            return klass
+        bases = tuple(cls._rebase(base, reloaded) for base in klass.__bases__)
+        if bases != klass.__bases__:
+            klass.__bases__ = bases
+        return klass
+
+    def _onHandover(self):
+        """Called when a standby takes over. Mixins which depend on the start time should extend this."""
+        pass
+
+    async def _onStart(self):
+        """Called once the bot has been initialised, before it starts taking updates. Mixins which run background work (e.g. jobs) should extend this."""
+        pass
+
+    async def _onStop(self):
+        """Called once the bot has stopped, before it is shut down. Mixins which hold resources (e.g. connections) should extend this."""
+        if self._stateStore is not None:
+            await self._stateStore.close()
+
+    def _statusLines(self):
+        """Lines of text about the bot's workings, shown by StatusInterface's /status. Mixins with their own workings should extend this."""
+        lines = []
+        processor = self._app.update_processor
+        if isinstance(processor, PerChatUpdateProcessor):
+            lines.append("Updates: %d running, %d queued across %d chat(s), up to %d at once" % (
+                processor.running, processor.queued, processor.activeChats, processor.max_concurrent_updates))
+        pools = self._executors.report()
+        if pools:
+            lines.append(pools)
+        if self._stateStore is not None:
+            stats = self._stateStore.stats()
+            lines.append("State: %d cached, %d hits, %d misses (%.0f%% hit rate), %d pending writes" % (
+                stats["cached"], stats["hits"], stats["misses"], stats["hitRate"] * 100, stats["pending"]))
+        return lines
+
+    @staticmethod
+    def _buildApp(token: str, concurrentUpdates=None, baseUrl: str=None, baseFileUrl: str=None, transport: Transport=None):
+        """
+        Builds the application for a given token.
+
+        Parameters
+        ----------
+        token : str
+            The bot token.
+        concurrentUpdates : int or BaseUpdateProcessor
+            Number of updates to process concurrently, with updates from the same chat still processed in order
+            (see PerChatUpdateProcessor). Alternatively, any BaseUpdateProcessor to use instead.
+            Defaults to None, which processes updates sequentially.
+        baseUrl : str
+            Alternative Bot API endpoint, e.g. a local fake server for testing.
+            Defaults to None, which uses the official https://api.telegram.org/bot.
+        baseFileUrl : str
+            Alternative file download endpoint, similar to baseUrl.
+        transport : Transport
+            Pool sizes, timeouts and HTTP version for the Bot API requests; see transport.py.
+            Containers given the same Transport share its connection pool for sends.
+            Defaults to None, which uses python-telegram-bot's default requests.
+        """
+        builder = ApplicationBuilder().token(token)
+        if transport is not None:
+            builder = transport.apply(builder)
+        if concurrentUpdates is not None:
+            if not isinstance(concurrentUpdates, BaseUpdateProcessor):
+                concurrentUpdates = PerChatUpdateProcessor(concurrentUpdates)
+            builder = builder.concurrent_updates(concurrentUpdates)
+        if baseUrl is not None:
+            builder = builder.base_url(baseUrl)
+        if baseFileUrl is not None:
+            builder = builder.base_file_url(baseFileUrl)
+        return builder.build()
 
     @classmethod
-    def fromEnvVar(cls, envVar: str):
-        '''Initialisation from an environment variable containing the bot token.'''
+    def fromEnvVar(cls, envVar: str, **kwargs):
+        '''Initialisation from an environment variable containing the bot token. See _buildApp() for the keyword arguments.'''
         token = os.environ[envVar]
-        container = cls(ApplicationBuilder().token(token).build())
+        container = cls(cls._buildApp(token, **kwargs))
         return container
     
     @classmethod
-    def fromTokenString(cls, token: str):
-        '''Initialisation from a string containing the bot token.'''
-        container = cls(ApplicationBuilder().token(token).build())
+    def fromTokenString(cls, token: str, **kwargs):
+        '''Initialisation from a string containing the bot token. See _buildApp() for the keyword arguments.'''
+        container = cls(cls._buildApp(token, **kwargs))
         return container
 
-#%%
-class AliveFilter(MessageFilter):
-    '''Prevents messages/commands sent before the bot started from being processed.'''
-    def __init__(self, t0: float, *args, **kwargs):
-        self._t0 = t0
-        super().__init__(*args, **kwargs)
+#%% Update processing
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates from different chats concurrently, up to a limit, while updates from the same chat
+    are processed strictly one after another, in the order they arrived.
+
+    An update only takes one of the concurrent slots once the previous update from its chat has finished,
+    so a busy chat (e.g. a long /execute) cannot hold up the others. Updates without a chat are ordered by user,
+    and those without either are not ordered.
+    """
+    def __init__(self, maxConcurrent: int=32):
+        super().__init__(maxConcurrent)
+        self._chats = dict() # Key -> [lock, number of its updates queued or running]
+        self._inside = 0
+        self._running = 0
 
     @property
-    def t0(self):
-        return self._t0
+    def running(self):
+        """Number of updates being processed."""
+        return self._running
 
-    def filter(self, message):
-        print("Msg: %f\nBot start: %f" % (message.date.timestamp(), self._t0))
-        return message.date.timestamp() > self._t0
+    @property
+    def queued(self):
+        """Number of updates waiting, either for an earlier update from their chat, or for a free slot."""
+        return self._inside - self._running
+
+    @property
+    def activeChats(self):
+        """Number of chats with updates queued or running."""
+        return len(self._chats)
+
+    @staticmethod
+    def _key(update):
+        if isinstance(update, Update):
+            if update.effective_chat is not None:
+                return update.effective_chat.id
+            if update.effective_user is not None:
+                return ("user", update.effective_user.id)
+        return None
+
+    async def process_update(self, update, coroutine):
+        # Waits for the chat's turn before the base class waits for a slot
+        self._inside += 1
+        key = self._key(update)
+        try:
+            if key is None:
+                await super().process_update(update, coroutine)
+                return
+
+            entry = self._chats.get(key)
+            if entry is None:
+                entry = self._chats[key] = [asyncio.Lock(), 0]
+            entry[1] += 1
+            try:
+                async with entry[0]: # Locks are FIFO, so updates from a chat go in order
+                    await super().process_update(update, coroutine)
+            finally:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._chats[key]
+        finally:
+            self._inside -= 1
+
+    async def do_process_update(self, update, coroutine):
+        self._running += 1
+        try:
+            await coroutine
+        finally:
+            self._running -= 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+#%% Command routing
+class CommandRouter(BaseHandler):
+    """
+    A single handler which dispatches to CommandHandlers by command name.
+
+    The command is parsed once per update and looked up in a dictionary; only the
+    CommandHandlers registered for that command are then checked, in registration order.
+    If given a Metrics instance, the time spent in the filters and in the handler is recorded per command.
+    """
+    def __init__(self, metrics: Metrics=None):
+        super().__init__(None)
+        self._table = dict()
+        self._metrics = metrics
+
+    @property
+    def table(self):
+        return self._table
+
+    def add(self, handler: CommandHandler):
+        for command in handler.commands:
+            self._table.setdefault(command.lower(), []).append(handler)
+
+    def replaceTable(self, table: dict):
+        """Swaps in a whole new table at once, e.g. one built by another router; see BotContainer.reloadHandlers()."""
+        self._table = table
+
+    def check_update(self, update):
+        if not isinstance(update, Update):
+            return None
+        # Parsed once per update, and shared with the built-in filters
+        record = recordOf(update)
+        if record is None or record.command is None:
+            return None
+
+        command = record.command
+        handlers = self._table.get(command)
+        if handlers is None:
+            return None
+
+        # Same semantics as a list of CommandHandlers in one group: the first match wins
+        t = time.perf_counter()
+        result = None
+        for handler in handlers:
+            check = handler.check_update(update)
+            if check is not None and check is not False:
+                result = command, handler, check
+                break
+        if self._metrics is not None:
+            self._metrics.observe(command, STAGE_FILTER, time.perf_counter() - t)
+        return result
+
+    async def handle_update(self, update, application, check_result, context):
+        command, handler, check = check_result
+        if handler.block is False:
+            application.create_task(self._timed(command, handler.handle_update(update, application, check, context)), update=update)
+            return None
+        return await self._timed(command, handler.handle_update(update, application, check, context))
+
+    async def _timed(self, command: str, coroutine):
+        token = currentCommand.set(command)
+        t = time.perf_counter()
+        try:
+            return await coroutine
+        finally:
+            if self._metrics is not None:
+                self._metrics.observe(command, STAGE_HANDLER, time.perf_counter() - t)
+            currentCommand.reset(token)
 
 
 #%% 
 class StatusInterface:
+    # Path of the restart history file, set by the BotRunner; must match BotRunner.STATE_ENV
+    RUNNER_STATE_ENV = "BOT_RUNNER_STATE"
+
     def __init__(self, *args, **kwargs):
         self._t0 = dt.datetime.now(tz=dt.timezone.utc).timestamp()
         super().__init__(*args, **kwargs)
         
-        # Adds the filter to the universal list
-        self._ufilts.append(AliveFilter(self._t0))
+        # Old updates are dropped before they are fetched, at startup (and at handover, for a warm standby).
+        # The filter only catches the few which slip in between, e.g. when a standby was started before them
+        self.skipStaleUpdates = True
+        self._alivefilter = AliveFilter(self._t0)
+        self._ufilts.append(self._alivefilter)
         
-        print("Bot started at %f" % (self._t0))
+        logger.info("Bot started at %f", self._t0)
 
     def _addInterfaceHandlers(self):
         super()._addInterfaceHandlers()
-        print("Adding StatusInterface:status")
-        self._app.add_handler(CommandHandler('status', self.status, filters=self.ufilts))
+        logger.debug("Adding StatusInterface:status")
+        self.addCommand('status', self.status, filters=self.ufilts)
 
+    def _onHandover(self):
+        super()._onHandover()
+        # A standby was built before the previous process handled its last messages (e.g. the /restart itself),
+        # so only messages from the handover onwards count as new
+        self._t0 = dt.datetime.now(tz=dt.timezone.utc).timestamp()
+        self._alivefilter.t0 = self._t0
+        logger.info("Bot started at %f", self._t0)
 
     @property
     def elapsedSeconds(self):
         return dt.datetime.now(tz=dt.timezone.utc).timestamp() - self._t0
 
+    def runnerState(self):
+        """
+        The restart history kept by the BotRunner (or BotSupervisor) which started this bot, as a dictionary with
+        'runnerStarted', 'restarts' and 'history' (a list of exits, most recent last), or None if not started by one.
+        """
+        path = os.environ.get(self.RUNNER_STATE_ENV)
+        if path is None:
+            return None
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning("Could not read runner state from %s: %s", path, e)
+            return None
+
+    @cached(ttl=300, group="status")
+    def _runnerStatusText(self):
+        # The runner only writes the file when a process exits, so this rarely changes while we are running
+        state = self.runnerState()
+        if state is None:
+            return ""
+        text = "\nRestarted %d time(s) since the runner started at %s" % (
+            state["restarts"], dt.datetime.fromtimestamp(state["runnerStarted"]).strftime("%Y-%m-%d %H:%M:%S"))
+        if len(state["history"]) > 0:
+            last = state["history"][-1]
+            text += "\nLast exit: %s (return code %d) at %s, after running for %.0fs" % (
+                last["reason"], last["returncode"],
+                dt.datetime.fromtimestamp(last["time"]).strftime("%Y-%m-%d %H:%M:%S"), last["runtime"])
+        return text
+
     async def status(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="This bot began at %f and has been alive for %fs" % (self._t0, self.elapsedSeconds)
-        )
+        text = "This bot began at %f and has been alive for %fs" % (self._t0, self.elapsedSeconds)
+        text += self._runnerStatusText()
+        for line in self._statusLines():
+            text += "\n" + line
+        await self.reply(update, text)
+
+
+#%% Scheduler
+class SchedulerInterface:
+    """
+    This adds periodic jobs, on intervals or cron schedules, which run on the bot's event loop while it runs;
+    see scheduler.py. Add them with addJob() before run(), e.g. in __init__:
 
+        self.addJob("digest", self.sendDigest, cron="0 9 * * 1-5")
 
-#%% Experimental admin privilege filter
-class AdminFilter(MessageFilter):
-    '''Prevents messages/commands sent by non-admins from being processed.'''
-    def __init__(self, id: int, *args, **kwargs):
-        self._id = id
+    The last run of each job is kept in the container's state store, so runs missed while the bot was down
+    (e.g. across a restart by the BotRunner) are coalesced into a single run at startup.
+    StatusInterface shows each job's runs and durations in /status.
+    """
+    def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+        self._scheduler = Scheduler(executors=self._executors)
+        self.persistJobs = True # Keeps the last run of each job in the state store
+
     @property
-    def id(self):
-        return self._id
+    def scheduler(self):
+        return self._scheduler
+
+    def addJob(self, name: str, callback, interval: float=None, cron: str=None, firstDelay: float=None):
+        """Adds a job; see Scheduler.add(). Callbacks take no arguments, so should be bound methods if they need the bot."""
+        return self._scheduler.add(name, callback, interval=interval, cron=cron, firstDelay=firstDelay)
+
+    def setMaxConcurrentJobs(self, maxConcurrent: int):
+        """Sets the number of jobs which may run at once. Must be called before run()."""
+        self._scheduler.setMaxConcurrent(maxConcurrent)
+
+    async def _onStart(self):
+        await super()._onStart()
+        await self._scheduler.start(self.state if self.persistJobs else None, namespace="SchedulerInterface")
+
+    async def _onStop(self):
+        # Before the state store is closed, so the last runs are saved
+        await self._scheduler.stop()
+        await super()._onStop()
+
+    def _statusLines(self):
+        lines = super()._statusLines()
+        if self._scheduler.jobs:
+            lines.append("Jobs:\n" + self._scheduler.report())
+        return lines
 
-    def filter(self, message):
-        print("Msg from: %d\nAdmin: %d" % (message.from_user.id, self._id))
-        return message.from_user.id == self._id
 
 #%% Admin
 class AdminInterface:
     """
-    This is the basic admin interface, which provides a way to set the admin and then access the filter via self._adminfilter.
+    This is the basic admin interface, which keeps the roles of the bot's users (admins, operators and read-only users;
+    see roles.py) and provides the filter for each command via self._permitted(command).
+    self._adminfilter lets through admins only.
+
+    Which role each command needs is set in DEFAULT_COMMAND_ROLES, and can be changed per bot with setCommandRole()
+    before run(), e.g. setCommandRole('restart', ROLE_OPERATOR) or setCommandRole('metrics', ROLE_READONLY).
+    Every command needs an admin by default, including those not listed there.
     """
+    DEFAULT_COMMAND_ROLES = {
+        'admin': ROLE_ADMIN,
+        'roles': ROLE_ADMIN,
+        'execute': ROLE_ADMIN,
+        'cancel': ROLE_ADMIN,
+        'shutdown': ROLE_ADMIN,
+        'restart': ROLE_ADMIN,
+        'reload': ROLE_ADMIN,
+        'gitpull': ROLE_ADMIN,
+        'gitlog': ROLE_ADMIN,
+        'metrics': ROLE_ADMIN,
+        'getfile': ROLE_ADMIN,
+        'getzip': ROLE_ADMIN,
+        'upload': ROLE_ADMIN, # Sending a document to the bot
+        'broadcast': ROLE_ADMIN,
+        'cancelbroadcast': ROLE_ADMIN,
+    }
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        self._adminfilter = None
+        self._roles = Roles()
+        self._commandRoles = dict(self.DEFAULT_COMMAND_ROLES)
+        self._rolefilters = {role: RoleFilter(self._roles, role) for role in ROLES}
+        self._adminfilter = self._rolefilters[ROLE_ADMIN]
+
+    @property
+    def roles(self):
+        return self._roles
 
     def setAdmin(self, id: int):
-        self._adminfilter = AdminFilter(id)
+        """
+        Sets the bot's admin, replacing any other admins. See also the roles property, e.g. roles.add() for more admins,
+        or roles.load() to load all the roles from a file.
+        """
+        self._roles.set(ROLE_ADMIN, [id])
+
+    def setCommandRole(self, command: str, role: str):
+        """Sets the role a command needs. Must be called before run()."""
+        if role not in ROLES:
+            raise ValueError("Unknown role %s; use one of %s." % (role, ", ".join(ROLES)))
+        self._commandRoles[command] = role
+
+    def _permitted(self, command: str):
+        """The filter for users allowed to use a command."""
+        return self._rolefilters[self._commandRoles.get(command, ROLE_ADMIN)]
     
     def _addInterfaceHandlers(self):
         super()._addInterfaceHandlers()
 
-        if self._adminfilter is None:
+        if len(self._roles.members(ROLE_ADMIN)) == 0:
             raise ValueError("Specify an admin ID before continuing.")
         
-        print("Adding AdminInterface:admin")
-        self._app.add_handler(CommandHandler('admin', self.admin, filters=self.ufilts & self._adminfilter))
+        logger.debug("Adding AdminInterface:admin")
+        self.addCommand('admin', self.admin, filters=self.ufilts & self._permitted('admin'))
+        logger.debug("Adding AdminInterface:roles")
+        self.addCommand('roles', self.showRoles, filters=self.ufilts & self._permitted('roles'))
 
     async def admin(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="You have admin rights."
-        )
+        await self.reply(update, "You have admin rights.", priority=PRIORITY_HIGH)
+
+    async def showRoles(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        # '/roles reload' re-reads the roles file, so roles can be changed without restarting
+        if len(context.args) > 0 and context.args[0] == "reload":
+            try:
+                self._roles.load()
+            except (OSError, ValueError) as e:
+                await self.reply(update, "Could not reload roles, keeping the old ones: %s" % e, priority=PRIORITY_HIGH)
+                return
+        await self.reply(update, "\n".join(
+            "%s: %s" % (role, ", ".join(str(i) for i in sorted(self._roles.members(role))) or "-") for role in ROLES
+        ), priority=PRIORITY_HIGH)
 
 
 class SystemInterface(AdminInterface):
     """
     This inherits AdminInterface, and adds the ability to invoke system commands.
+    Commands run asynchronously, with their output streamed back to the chat, and can be killed with /cancel.
     """
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -163,16 +921,44 @@ class SystemInterface(AdminInterface):
     def _addInterfaceHandlers(self):
         super()._addInterfaceHandlers()
 
-        print("Adding SystemInterface:execute")
-        self._app.add_handler(CommandHandler('execute', self.execute, filters=self.ufilts & self._adminfilter))
+        logger.debug("Adding SystemInterface:execute")
+        # Not blocking, so that updates after it (in particular /cancel, from the same chat) are still handled while it runs
+        self.addCommand('execute', self.execute, filters=self.ufilts & self._permitted('execute'), block=False)
+        logger.debug("Adding SystemInterface:cancel")
+        self.addCommand('cancel', self.cancel, filters=self.ufilts & self._permitted('cancel'))
 
     async def execute(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        returncode = os.system(" ".join(context.args))
+        async def sendOutput(text: str):
+            await self.reply(update, text, priority=PRIORITY_HIGH)
+
+        try:
+            returncode = await self._subprocs.run(" ".join(context.args), shell=True, onOutput=sendOutput)
+            text = "Return code: %d" % returncode
+        except asyncio.TimeoutError:
+            text = "Command timed out and was killed."
+
+        await self.reply(update, text, priority=PRIORITY_HIGH)
 
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="Return code: %d" % returncode
-        )
+    async def cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        killed = self._subprocs.cancelAll()
+        await self.reply(update, "Cancelled %d running command(s)." % killed, priority=PRIORITY_HIGH)
+
+
+class MetricsInterface(AdminInterface):
+    """
+    This inherits AdminInterface, and adds /metrics (for admins, by default), which shows the latency and rate of every command,
+    split into filter, handler and Telegram API (send) time. See also BotContainer.serveMetrics().
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+    def _addInterfaceHandlers(self):
+        super()._addInterfaceHandlers()
+        logger.debug("Adding MetricsInterface:metrics")
+        self.addCommand('metrics', self.showMetrics, filters=self.ufilts & self._permitted('metrics'))
+
+    async def showMetrics(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await self.reply(update, self._metrics.report(), priority=PRIORITY_HIGH)
 
 #%%
 class ControlInterface(AdminInterface):
@@ -181,24 +967,36 @@ class ControlInterface(AdminInterface):
 
     def _addInterfaceHandlers(self):
         super()._addInterfaceHandlers()
-        print("Adding ControlInterface:shutdown")
-        self._app.add_handler(CommandHandler('shutdown', self.shutdown, filters=self.ufilts & self._adminfilter))
-        print("Adding ControlInterface:restart")
-        self._app.add_handler(CommandHandler('restart', self.restart, filters=self.ufilts & self._adminfilter))
+        logger.debug("Adding ControlInterface:shutdown")
+        self.addCommand('shutdown', self.shutdown, filters=self.ufilts & self._permitted('shutdown'))
+        logger.debug("Adding ControlInterface:restart")
+        self.addCommand('restart', self.restart, filters=self.ufilts & self._permitted('restart'))
+        logger.debug("Adding ControlInterface:reload")
+        self.addCommand('reload', self.reload, filters=self.ufilts & self._permitted('reload'))
 
     async def shutdown(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="Shutting down.."
-        )
-        os._exit(0) # This is the shut down code for the bot runner.
+        await self.reply(update, "Shutting down..", priority=PRIORITY_HIGH, wait=True)
+        self.exitAfterDrain(self.SHUTDOWN_CODE)
 
     async def restart(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="Restarting.."
-        )
-        os._exit(1) # Any number other than 0 will restart the bot in the bot runner.
+        # '/restart cold' skips the bot runner's warm standby, e.g. to load code that was just pulled
+        cold = len(context.args) > 0 and context.args[0] == "cold"
+        await self.reply(update, "Restarting%s.." % (" (cold)" if cold else ""), priority=PRIORITY_HIGH, wait=True)
+        self.exitAfterDrain(self.COLD_RESTART_CODE if cold else self.RESTART_CODE) # Restarted by the bot runner at once
+
+    async def reload(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        # Picks up changed handler code without restarting; see BotContainer.reloadHandlers() for what this covers
+        t = time.perf_counter()
+        try:
+            reloaded = self.reloadHandlers()
+        except Exception as e:
+            logger.exception("Reload failed")
+            await self.reply(update, "Reload failed, keeping the old handlers: %r" % e, priority=PRIORITY_HIGH)
+            return
+        if len(reloaded) == 0:
+            await self.reply(update, "Nothing to reload.", priority=PRIORITY_HIGH)
+        else:
+            await self.reply(update, "Reloaded %s in %.1fms." % (", ".join(reloaded), (time.perf_counter() - t) * 1000), priority=PRIORITY_HIGH)
 
 class GitInterface(AdminInterface):
     def __init__(self, *args, **kwargs):
@@ -206,105 +1004,228 @@ class GitInterface(AdminInterface):
 
     def _addInterfaceHandlers(self):
         super()._addInterfaceHandlers()
-        print("Adding GitInterface:gitpull")
-        self._app.add_handler(CommandHandler('gitpull', self.gitPull, filters=self.ufilts & self._adminfilter))
-        print("Adding GitInterface:gitLog")
-        self._app.add_handler(CommandHandler('gitlog', self.gitLog, filters=self.ufilts & self._adminfilter))
+        logger.debug("Adding GitInterface:gitpull")
+        self.addCommand('gitpull', self.gitPull, filters=self.ufilts & self._permitted('gitpull'))
+        logger.debug("Adding GitInterface:gitLog")
+        self.addCommand('gitlog', self.gitLog, filters=self.ufilts & self._permitted('gitlog'))
 
     async def gitPull(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        os.system("git pull")
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="Git pull complete."
-        )
+        returncode, output = await self._subprocs.output(['git', 'pull'])
+        self.invalidateCache("git")
+        await self.reply(update, "Git pull complete. Use /reload to load changed handlers, or /restart cold to run all the new code." if returncode == 0 else "Git pull failed (%d):\n%s" % (returncode, output), priority=PRIORITY_HIGH)
+
+    @cached(ttl=600, group="git", cacheIf=lambda result: result[0] == 0)
+    async def _gitLog(self):
+        # Only changes with a pull, which invalidates this; the TTL covers commits made outside the bot.
+        # Failures are not cached, so that they are retried at the next /gitlog
+        return await self._subprocs.output(['git', 'log', '-1', '--oneline'])
 
     async def gitLog(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        gitlogstr = subprocess.check_output(['git', 'log', '-1', '--oneline']).strip().decode('utf-8')
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text=gitlogstr
-        )
+        returncode, output = await self._gitLog()
+        await self.reply(update, output if returncode == 0 else "Git log failed (%d):\n%s" % (returncode, output), priority=PRIORITY_HIGH)
 
 
-#%% Context filtering
-class PrivateOnlyChatFilter(MessageFilter):
+class FileInterface(AdminInterface):
     """
-    Filter that only allows messages sent to a private chat.
+    This inherits AdminInterface, and adds file transfers: /getfile sends a file from disk, /getzip zips files or
+    folders and sends the zip, and documents sent to the bot are saved to the download folder.
+    Transfers are streamed, so files are never loaded into memory; see file_transfer.py.
+
+    The download folder defaults to 'downloads' in the working folder, and is created on the first download.
+    Existing files there are not overwritten, unless overwriteDownloads is set.
     """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
 
-    def filter(self, message):
-        chat = message.chat
-        return chat.type == constants.ChatType.PRIVATE
-    
-class GroupOnlyChatFilter(MessageFilter):
+        self._files = FileTransfer(self._app.bot, executors=self._executors)
+        self.downloadDir = os.path.join(os.getcwd(), "downloads")
+        self.overwriteDownloads = False
+
+    @property
+    def files(self):
+        return self._files
+
+    def setDownloadDir(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        self.downloadDir = path
+
+    def _addInterfaceHandlers(self):
+        super()._addInterfaceHandlers()
+        logger.debug("Adding FileInterface:getfile")
+        self.addCommand('getfile', self.getFile, filters=self.ufilts & self._permitted('getfile'))
+        logger.debug("Adding FileInterface:getzip")
+        self.addCommand('getzip', self.getZip, filters=self.ufilts & self._permitted('getzip'))
+        logger.debug("Adding FileInterface:upload")
+        self.addHandler(MessageHandler(self.ufilts & self._permitted('upload') & DocumentFilter.ALL, self.saveDocument))
+
+    async def _onStop(self):
+        await super()._onStop()
+        await self._files.close()
+
+    @staticmethod
+    def _transferError(e: Exception):
+        """Text for a failed transfer which is safe to send to the chat."""
+        if isinstance(e, httpx.HTTPError):
+            # httpx's messages contain the URL, and so the bot's token
+            return "network error (%s)" % type(e).__name__
+        return str(e)
+
+    async def getFile(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if len(context.args) != 1:
+            await self.reply(update, "Usage: /getfile path", priority=PRIORITY_HIGH)
+            return
+        try:
+            await self._files.upload(update.effective_chat.id, context.args[0])
+        except (OSError, FileTooLarge, RuntimeError, ValueError, httpx.HTTPError) as e:
+            await self.reply(update, "Could not send %s: %s" % (context.args[0], self._transferError(e)), priority=PRIORITY_HIGH)
+
+    async def getZip(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if len(context.args) == 0:
+            await self.reply(update, "Usage: /getzip path [path ...]", priority=PRIORITY_HIGH)
+            return
+        try:
+            await self._files.uploadZipped(update.effective_chat.id, context.args)
+        except (OSError, FileTooLarge, RuntimeError, ValueError, httpx.HTTPError) as e:
+            await self.reply(update, "Could not send the zip: %s" % self._transferError(e), priority=PRIORITY_HIGH)
+
+    async def saveDocument(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        document = update.effective_message.document
+        path = os.path.join(self.downloadDir, os.path.basename(document.file_name or document.file_unique_id))
+        try:
+            os.makedirs(self.downloadDir, exist_ok=True)
+            size = await self._files.download(document.file_id, path, size=document.file_size, overwrite=self.overwriteDownloads)
+        except FileExistsError:
+            await self.reply(update, "Not downloading %s: a file of that name is already in the download folder." % document.file_name, priority=PRIORITY_HIGH)
+            return
+        except (OSError, FileTooLarge, TransferFailed, httpx.HTTPError) as e:
+            await self.reply(update, "Could not download %s: %s" % (document.file_name, self._transferError(e)), priority=PRIORITY_HIGH)
+            return
+        await self.reply(update, "Downloaded %s (%d bytes)" % (document.file_name, size), priority=PRIORITY_HIGH)
+
+
+class BroadcastInterface(AdminInterface):
     """
-    Filter that only allows messages sent to a group chat.
+    This inherits AdminInterface, and adds /broadcast text, which sends a message to every chat in broadcastChats(),
+    /broadcast alone, which shows its progress, and /cancelbroadcast. See broadcast.py for how the messages are sent.
+
+    Progress is checkpointed in the container's state store, and an unfinished broadcast resumes when the bot starts
+    again. Set the chats with setBroadcastChats(), or override broadcastChats() to look them up when a broadcast starts.
     """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self._broadcastChats = []
+        self._broadcaster = None # Created at startup, once the state store can be opened
+
+    @property
+    def broadcaster(self):
+        return self._broadcaster
+
+    def setBroadcastChats(self, chatIds: list):
+        self._broadcastChats = list(chatIds)
+
+    async def broadcastChats(self):
+        """The chat IDs which /broadcast sends to."""
+        return self._broadcastChats
+
+    def _addInterfaceHandlers(self):
+        super()._addInterfaceHandlers()
+        logger.debug("Adding BroadcastInterface:broadcast")
+        self.addCommand('broadcast', self.broadcast, filters=self.ufilts & self._permitted('broadcast'))
+        logger.debug("Adding BroadcastInterface:cancelbroadcast")
+        self.addCommand('cancelbroadcast', self.cancelBroadcast, filters=self.ufilts & self._permitted('cancelbroadcast'))
+
+    async def _onStart(self):
+        await super()._onStart()
+        self._broadcaster = Broadcaster(self._outbox, self.state, namespace="BroadcastInterface")
+        self._broadcaster.onFinished = self._broadcastFinished
+        broadcast = await self._broadcaster.resume()
+        if broadcast is not None and broadcast.notifyChat is not None:
+            await self.reply(broadcast.notifyChat, "Resumed after a restart. " + broadcast.report(), priority=PRIORITY_HIGH)
+
+    async def _drain(self):
+        # Stopped first, so that the drain only waits for the messages already queued
+        if self._broadcaster is not None:
+            await self._broadcaster.stop()
+        await super()._drain()
+
+    async def _onStop(self):
+        if self._broadcaster is not None:
+            await self._broadcaster.stop()
+        await super()._onStop()
+
+    def _statusLines(self):
+        lines = super()._statusLines()
+        if self._broadcaster is not None and self._broadcaster.running:
+            lines.append(self._broadcaster.report())
+        return lines
+
+    async def _broadcastFinished(self, broadcast):
+        if broadcast.notifyChat is not None:
+            await self.reply(broadcast.notifyChat, broadcast.report(), priority=PRIORITY_HIGH)
+
+    async def broadcast(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if len(context.args) == 0:
+            await self.reply(update, self._broadcaster.report(), priority=PRIORITY_HIGH)
+            return
+        if self._broadcaster.running:
+            await self.reply(update, "A broadcast is already running; use /cancelbroadcast first.\n" + self._broadcaster.report(), priority=PRIORITY_HIGH)
+            return
+        # Everything after the command, with its line breaks
+        text = update.effective_message.text.split(None, 1)[1]
+        chats = await self.broadcastChats()
+        self._broadcaster.start(chats, text, notifyChat=update.effective_chat.id)
+        await self.reply(update, "Broadcasting to %d chat(s).." % len(chats), priority=PRIORITY_HIGH)
 
-    def filter(self, message):
-        chat = message.chat
-        return chat.type == constants.ChatType.GROUP
+    async def cancelBroadcast(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        broadcast = await self._broadcaster.cancel()
+        await self.reply(update, "No broadcast is running." if broadcast is None else broadcast.report(), priority=PRIORITY_HIGH)
 
 
 #%%
 if __name__ == "__main__":
-    import sys
+    from bot_logging import setupLogging
+    setupLogging()
 
-    class GenericBot(GitInterface, SystemInterface, ControlInterface, StatusInterface, BotContainer):
+    class GenericBot(FileInterface, MetricsInterface, GitInterface, SystemInterface, ControlInterface, StatusInterface, BotContainer):
         def _addInterfaceHandlers(self):
             super()._addInterfaceHandlers()
 
-            self._app.add_handler(CommandHandler('private', self.testPrivateOnly, filters=self.ufilts & PrivateOnlyChatFilter()))
-            self._app.add_handler(CommandHandler('group', self.testGroupOnly, filters=self.ufilts & GroupOnlyChatFilter()))
-            self._app.add_handler(CommandHandler('link', self.testBotLink, filters=self.ufilts))
+            self.addCommand('private', self.testPrivateOnly, filters=self.ufilts & PrivateOnlyChatFilter())
+            self.addCommand('group', self.testGroupOnly, filters=self.ufilts & GroupOnlyChatFilter())
+            self.addCommand('link', self.testBotLink, filters=self.ufilts)
             
-            self._app.add_handler(CommandHandler('start', self.startWithParams, filters=self.ufilts & Regex("abc")))
+            self.addCommand('start', self.startWithParams, filters=self.ufilts & Regex("abc"))
             # Note that the /start with no params must be at the end of all the other /start handlers.
-            self._app.add_handler(CommandHandler('start', self.start, filters=self.ufilts))
+            self.addCommand('start', self.start, filters=self.ufilts)
             
 
         async def testPrivateOnly(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="This is a private message."
-            )
+            await self.reply(update, "This is a private message.")
 
         async def testGroupOnly(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="This is a group message."
-            )
+            await self.reply(update, "This is a group message.")
 
         async def testBotLink(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
             link = self.link(start="abc-def")
-            print(link)
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                parse_mode=constants.ParseMode.MARKDOWN_V2,
-                text="[Click me](%s)" % link
-            )
+            logger.debug("Bot link: %s", link)
+            await self.reply(update, "[Click me](%s)" % link, parse_mode=constants.ParseMode.MARKDOWN_V2)
 
         async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
             url = helpers.create_deep_linked_url(self.botname, "abc-def") #, group=True)
             text = "Feel free to tell your friends about it:\n\n" + url
 
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="This is the start message." + text
-            )
+            await self.reply(update, "This is the start message." + text)
 
         async def startWithParams(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
             payload = context.args[0]
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="You see this only cause of params: %s" % payload
-            )
+            await self.reply(update, "You see this only cause of params: %s" % payload)
 
     bot = GenericBot.fromEnvVar('TELEGRAM_TEST_TOKEN')
     bot.setAdmin(int(sys.argv[1]))
     if len(sys.argv) > 2:
         bot.setBotname(sys.argv[2])
-    print(GenericBot.__mro__)
+    logger.debug("%s", GenericBot.__mro__)
     bot.run()
 
 
@@ -0,0 +1,186 @@
+#%% Thread and process pools for handler work which would otherwise block the event loop.
+# Blocking I/O (e.g. a synchronous client library) should go to the thread pool, and CPU-heavy work to the
+# process pool, which spreads it across cores. Both pools are created on first use and shared by the whole process;
+# BotContainer exposes them as self.executors, and shuts them down when the bot exits.
+#
+# Functions can be offloaded with a decorator, which turns them into coroutine functions:
+#
+#   @offload("process")
+#   def crunch(data):
+#       ...
+#
+#   class MyInterface:
+#       async def handler(self, update, context):
+#           result = await crunch(data)
+#
+# With "process", the function must be importable in the worker, i.e. a module-level function or a staticmethod,
+# and its arguments and result must be picklable. "thread" has no such restrictions.
+
+import asyncio
+import concurrent.futures
+import functools
+import importlib
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+THREAD = "thread"
+PROCESS = "process"
+
+def _resolve(module: str, qualname: str):
+    obj = importlib.import_module(module)
+    for part in qualname.split("."):
+        obj = getattr(obj, part)
+    # The decorated name refers to the async wrapper; we want the function it wraps
+    return getattr(obj, "__wrapped__", obj)
+
+def _call(fn, args, kwargs):
+    # Runs in the worker; the start time lets the caller work out how long the call was queued for
+    return time.time(), fn(*args, **kwargs)
+
+def _callByName(module: str, qualname: str, args, kwargs):
+    return _call(_resolve(module, qualname), args, kwargs)
+
+
+class _PoolStats:
+    __slots__ = ('submitted', 'completed', 'failed', 'waitTotal', 'waitMax', 'runTotal')
+
+    def __init__(self):
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.waitTotal = 0.0 # Seconds spent queued, over all completed calls
+        self.waitMax = 0.0
+        self.runTotal = 0.0
+
+
+class Executors:
+    """A thread pool and a process pool, created on first use, with queue depth and wait time statistics."""
+    def __init__(self, maxThreads: int=None, maxProcesses: int=None):
+        """
+        Parameters
+        ----------
+        maxThreads : int
+            Size of the thread pool. Defaults to None, which uses concurrent.futures' default.
+        maxProcesses : int
+            Size of the process pool. Defaults to None, which uses the number of CPUs.
+        """
+        self._sizes = {THREAD: maxThreads, PROCESS: maxProcesses}
+        self._pools = dict()
+        self._stats = {THREAD: _PoolStats(), PROCESS: _PoolStats()}
+
+    def configure(self, maxThreads: int=None, maxProcesses: int=None):
+        """Sets the pool sizes. Has no effect on a pool which has already been created."""
+        self._sizes = {THREAD: maxThreads, PROCESS: maxProcesses}
+
+    def _pool(self, kind: str):
+        pool = self._pools.get(kind)
+        if pool is None:
+            if kind == THREAD:
+                pool = concurrent.futures.ThreadPoolExecutor(self._sizes[THREAD], thread_name_prefix="bot-executor")
+            elif kind == PROCESS:
+                pool = concurrent.futures.ProcessPoolExecutor(self._sizes[PROCESS])
+            else:
+                raise ValueError("Unknown executor %s; use '%s' or '%s'." % (kind, THREAD, PROCESS))
+            self._pools[kind] = pool
+        return pool
+
+    def workers(self, kind: str):
+        pool = self._pools.get(kind)
+        if pool is None:
+            return 0
+        return pool._max_workers
+
+    def pending(self, kind: str):
+        """Calls submitted but not yet finished."""
+        stats = self._stats[kind]
+        return stats.submitted - stats.completed - stats.failed
+
+    def queued(self, kind: str):
+        """Estimated number of calls waiting for a free worker."""
+        return max(0, self.pending(kind) - self.workers(kind))
+
+    async def run(self, kind: str, fn, *args, **kwargs):
+        """Runs fn(*args, **kwargs) in the thread or process pool, and returns its result."""
+        return await self._submit(kind, _call, fn, args, kwargs)
+
+    async def _submit(self, kind: str, call, *callArgs):
+        pool = self._pool(kind)
+        stats = self._stats[kind]
+        stats.submitted += 1
+        submitted = time.time()
+        try:
+            started, result = await asyncio.get_running_loop().run_in_executor(pool, call, *callArgs)
+        except BaseException:
+            stats.failed += 1
+            raise
+        finished = time.time()
+        stats.completed += 1
+        wait = max(0.0, started - submitted)
+        stats.waitTotal += wait
+        stats.waitMax = max(stats.waitMax, wait)
+        stats.runTotal += finished - started
+        return result
+
+    def stats(self):
+        """Dictionary of statistics for each pool which has been used."""
+        out = dict()
+        for kind, s in self._stats.items():
+            if s.submitted == 0:
+                continue
+            done = s.completed or 1
+            out[kind] = dict(
+                workers=self.workers(kind),
+                pending=self.pending(kind),
+                queued=self.queued(kind),
+                completed=s.completed,
+                failed=s.failed,
+                meanWait=s.waitTotal / done,
+                maxWait=s.waitMax,
+                meanRun=s.runTotal / done,
+            )
+        return out
+
+    def report(self):
+        lines = []
+        for kind, s in self.stats().items():
+            lines.append("%s pool: %d worker(s), %d pending (%d queued), %d done, %d failed; wait mean %.1fms max %.1fms, run mean %.1fms" % (
+                kind, s["workers"], s["pending"], s["queued"], s["completed"], s["failed"],
+                s["meanWait"] * 1000, s["maxWait"] * 1000, s["meanRun"] * 1000))
+        return "\n".join(lines)
+
+    def shutdown(self, wait: bool=False, kill: bool=False):
+        """
+        Shuts down the pools, cancelling calls which have not started yet.
+        With kill, the process pool's workers are also terminated, along with the calls they are running.
+        Pools are created again if used afterwards.
+        """
+        pools, self._pools = self._pools, dict()
+        for kind, pool in pools.items():
+            if kill and kind == PROCESS:
+                for process in list((pool._processes or {}).values()):
+                    process.terminate()
+            pool.shutdown(wait=wait, cancel_futures=True)
+
+
+# Shared by every container in the process
+executors = Executors()
+
+def offload(kind: str=PROCESS):
+    """
+    Decorator which makes a function run in the shared thread or process pool when awaited.
+    See the top of this file for the restrictions on functions run in the process pool.
+    """
+    if kind not in (THREAD, PROCESS):
+        raise ValueError("Unknown executor %s; use '%s' or '%s'." % (kind, THREAD, PROCESS))
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            if kind == PROCESS:
+                # The worker looks the function up by name, as the name now refers to this wrapper, which can't be pickled
+                return await executors._submit(kind, _callByName, fn.__module__, fn.__qualname__, args, kwargs)
+            return await executors._submit(kind, _call, fn, args, kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,162 @@
+#%% Streaming file transfers to and from Telegram, used by the FileInterface.
+# Files are never held in memory as a whole: downloads are written to disk chunk by chunk as they arrive,
+# uploads are read from disk chunk by chunk as they are sent, and zipping is done by a worker thread
+# straight into a temporary file. All requests go through one pooled HTTP client, so repeated transfers
+# reuse their connections to the Bot API.
+#
+# The Bot API limits downloads through getFile to 20MB, and uploads to 50MB, which are the default limits here.
+#
+# The URLs of the Bot API contain the bot's token, so failures are raised as TransferFailed with the HTTP status only,
+# never with httpx's messages, which include the URL.
+
+import os
+import tempfile
+import zipfile
+import logging
+
+import httpx
+
+try:
+    from .executors import executors as sharedExecutors, THREAD
+except ImportError: # Running from the same folder as a script
+    from executors import executors as sharedExecutors, THREAD
+
+logger = logging.getLogger(__name__)
+
+MAX_DOWNLOAD_SIZE = 20 * 1024 * 1024
+MAX_UPLOAD_SIZE = 50 * 1024 * 1024
+
+class FileTooLarge(Exception):
+    pass
+
+class TransferFailed(RuntimeError):
+    """The Bot API refused a transfer; the message never contains the URL."""
+    pass
+
+
+class FileTransfer:
+    """Streams files between disk and the Bot API for a bot, over a pooled HTTP client created on first use."""
+    def __init__(self, bot, maxDownloadSize: int=MAX_DOWNLOAD_SIZE, maxUploadSize: int=MAX_UPLOAD_SIZE,
+                 chunkSize: int=64 * 1024, maxConnections: int=4, executors=None):
+        """
+        Parameters
+        ----------
+        bot : telegram.Bot
+            The bot whose token and endpoints are used.
+        maxDownloadSize, maxUploadSize : int
+            Size limits in bytes. Transfers over these fail with FileTooLarge.
+        chunkSize : int
+            Bytes per read or write.
+        maxConnections : int
+            Size of the HTTP connection pool.
+        executors : Executors
+            Pools for the disk writes and the zipping; see executors.py. Defaults to the shared one.
+        """
+        self._bot = bot
+        self.maxDownloadSize = maxDownloadSize
+        self.maxUploadSize = maxUploadSize
+        self._chunkSize = chunkSize
+        self._maxConnections = maxConnections
+        self._executors = sharedExecutors if executors is None else executors
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self._maxConnections, max_keepalive_connections=self._maxConnections),
+                timeout=httpx.Timeout(30.0, read=300.0, write=300.0),
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def download(self, fileId: str, path: str, size: int=None, overwrite: bool=False):
+        """
+        Streams a file from Telegram to a path on disk, and returns the number of bytes written.
+        If the size is known in advance (e.g. Document.file_size) it is checked before downloading.
+        A partial file is removed if the download fails. Unless overwrite is True, an existing file at the path
+        is left alone, and FileExistsError is raised.
+        """
+        if size is not None and size > self.maxDownloadSize:
+            raise FileTooLarge("File is %d bytes; the limit is %d." % (size, self.maxDownloadSize))
+
+        tgfile = await self._bot.get_file(fileId)
+        url = tgfile.file_path
+        if not url.startswith(("http://", "https://")): # Only a path is given by some Bot API servers
+            url = "%s/%s" % (self._bot.base_file_url, url)
+
+        written = 0
+        f = await self._executors.run(THREAD, open, path, "wb" if overwrite else "xb")
+        try:
+            async with self.client.stream("GET", url) as response:
+                # Not raise_for_status(), whose message contains the URL, and so the token
+                if response.status_code != 200:
+                    raise TransferFailed("Download failed with HTTP status %d." % response.status_code)
+                async for chunk in response.aiter_bytes(self._chunkSize):
+                    written += len(chunk)
+                    if written > self.maxDownloadSize:
+                        raise FileTooLarge("File is over the limit of %d bytes." % self.maxDownloadSize)
+                    await self._executors.run(THREAD, f.write, chunk)
+        except BaseException:
+            f.close()
+            os.remove(path)
+            raise
+        await self._executors.run(THREAD, f.close)
+        logger.info("Downloaded %d bytes to %s", written, path)
+        return written
+
+    async def upload(self, chatId: int, path: str, filename: str=None, caption: str=None):
+        """Streams a file from disk to a chat as a document, and returns the API's result as a dictionary."""
+        size = os.path.getsize(path)
+        if size > self.maxUploadSize:
+            raise FileTooLarge("File is %d bytes; the limit is %d." % (size, self.maxUploadSize))
+
+        data = {"chat_id": str(chatId)}
+        if caption is not None:
+            data["caption"] = caption
+        with open(path, "rb") as f:
+            # httpx reads file objects in chunks while sending the multipart body
+            response = await self.client.post(
+                "%s/sendDocument" % self._bot.base_url,
+                data=data,
+                files={"document": (filename or os.path.basename(path), f, "application/octet-stream")},
+            )
+        # Errors from the Bot API itself are JSON, but those from a proxy in between (e.g. a 413 or a 502) may not be
+        if response.status_code != 200 and not response.headers.get("content-type", "").startswith("application/json"):
+            raise TransferFailed("sendDocument failed with HTTP status %d." % response.status_code)
+        try:
+            result = response.json()
+        except ValueError:
+            raise TransferFailed("sendDocument failed with HTTP status %d; the response was not JSON." % response.status_code) from None
+        if not result.get("ok"):
+            raise TransferFailed("sendDocument failed: %s" % result.get("description"))
+        logger.info("Uploaded %s (%d bytes) to %s", path, size, chatId)
+        return result["result"]
+
+    async def uploadZipped(self, chatId: int, paths: list, filename: str="files.zip", compresslevel: int=6, caption: str=None):
+        """Zips files or folders into a temporary file in a worker thread, and then uploads that."""
+        fd, zipPath = tempfile.mkstemp(suffix=".zip")
+        os.close(fd)
+        try:
+            await self._executors.run(THREAD, self.zipFiles, paths, zipPath, compresslevel)
+            return await self.upload(chatId, zipPath, filename=filename, caption=caption)
+        finally:
+            os.remove(zipPath)
+
+    @staticmethod
+    def zipFiles(paths: list, zipPath: str, compresslevel: int=6):
+        """Compression levels 0 (no compression) to 9 (max compression). zipfile streams each file in chunks."""
+        with zipfile.ZipFile(zipPath, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as z:
+            for path in paths:
+                if os.path.isdir(path):
+                    base = os.path.dirname(os.path.abspath(path))
+                    for root, _, files in os.walk(path):
+                        for name in files:
+                            full = os.path.join(root, name)
+                            z.write(full, os.path.relpath(full, base))
+                else:
+                    z.write(path, os.path.basename(path))
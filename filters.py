@@ -0,0 +1,226 @@
+#%% Filters used by the interfaces.
+# These only depend on telegram's filters, so they can be imported on their own, e.g.
+#   from common_bot_interfaces.filters import AdminFilter
+# without loading the containers, the command router or the outbound queue. Importing telegram.ext.filters
+# still loads all of telegram.ext, including its application and HTTP stack (httpx), so this is not much lighter
+# than importing the whole package.
+
+from telegram.ext.filters import UpdateFilter
+from telegram import MessageEntity, constants
+import datetime as dt
+import logging
+
+logger = logging.getLogger(__name__)
+
+#%% Filter registry
+class CompiledFilter(UpdateFilter):
+    """
+    A flat, short-circuiting AND over a set of filters.
+
+    Unlike chaining filters with &, which nests a MergedFilter per pair, this holds the filters
+    in a single tuple sorted by their 'cost' attribute (cheapest first; filters without one are
+    assumed to be expensive). Filters are treated as plain boolean filters; the dictionary
+    results of data filters are not merged.
+
+    With cacheResults, the result for the last update is remembered, so the same update
+    passing through many handlers only evaluates the filters once.
+    """
+    DEFAULT_COST = 10
+
+    def __init__(self, filts, cacheResults: bool=False, *args, **kwargs):
+        self._filts = tuple(sorted(filts, key=lambda f: getattr(f, 'cost', self.DEFAULT_COST)))
+        self._cacheResults = cacheResults
+        self._lastUpdate = None
+        self._lastResult = False
+        super().__init__(*args, **kwargs)
+
+    @property
+    def filts(self):
+        return self._filts
+
+    def filter(self, update):
+        if self._cacheResults and update is self._lastUpdate:
+            return self._lastResult
+
+        result = True
+        for f in self._filts:
+            if not f.check_update(update):
+                result = False
+                break
+
+        if self._cacheResults:
+            self._lastUpdate = update
+            self._lastResult = result
+        return result
+
+
+#%% Compact per-update record
+_UNSET = object()
+
+class UpdateRecord:
+    """
+    The few fields of an update which the built-in filters look at.
+    There is one record, reused for every update (see recordOf()), so making it allocates nothing: the chat and
+    user fields are references to existing objects, and the timestamp and the command, which do allocate,
+    are only worked out the first time a filter asks for them.
+    A record is only valid until the next update, so it must not be kept.
+    """
+    __slots__ = ('update', 'message', 'chatId', 'chatType', 'userId', 'date', '_timestamp', '_command')
+
+    def __init__(self):
+        self.update = None
+        self.message = None
+
+    def fill(self, update, message):
+        self.update = update
+        self.message = message
+        chat = message.chat
+        self.chatId = chat.id
+        self.chatType = chat.type
+        user = message.from_user
+        self.userId = None if user is None else user.id # None for e.g. channel posts
+        self.date = message.date # An aware datetime, which compares without converting it to a timestamp
+        self._timestamp = _UNSET
+        self._command = _UNSET
+
+    @property
+    def timestamp(self):
+        if self._timestamp is _UNSET:
+            self._timestamp = self.date.timestamp()
+        return self._timestamp
+
+    @property
+    def command(self):
+        """Lower case, without the slash or @botname; None if the message is not a command."""
+        if self._command is _UNSET:
+            self._command = None
+            message = self.message
+            entities = message.entities
+            if entities and message.text:
+                entity = entities[0]
+                if entity.type == MessageEntity.BOT_COMMAND and entity.offset == 0:
+                    self._command = message.text[1:entity.length].split('@')[0].lower()
+        return self._command
+
+
+# An update goes through all its filters before the next one starts, so one record serves every update
+_record = UpdateRecord()
+
+def recordOf(update):
+    """The UpdateRecord for an update, or None if it has no message."""
+    record = _record
+    if record.update is not update:
+        message = update.effective_message
+        if message is None:
+            return None
+        record.fill(update, message)
+    return record
+
+
+class RecordFilter(UpdateFilter):
+    """
+    Base class for filters which only need an UpdateRecord. Subclasses implement filterRecord().
+    As for a MessageFilter, updates without a message do not pass.
+    """
+    def check_update(self, update):
+        # Bypasses UpdateFilter's checks for each kind of message, which recordOf() covers
+        record = _record
+        if record.update is not update:
+            record = recordOf(update)
+            if record is None:
+                return False
+        return self.filterRecord(record)
+
+    def filter(self, update):
+        record = recordOf(update)
+        return record is not None and self.filterRecord(record)
+
+    def filterRecord(self, record: UpdateRecord):
+        raise NotImplementedError
+
+
+#%%
+class AliveFilter(RecordFilter):
+    '''
+    Prevents messages/commands sent before the bot started from being processed.
+    This is a fallback; the backlog is normally dropped before being fetched (see BotContainer.skipStaleUpdates).
+    '''
+    cost = 1
+
+    def __init__(self, t0: float, *args, **kwargs):
+        self.t0 = t0
+        super().__init__(*args, **kwargs)
+
+    @property
+    def t0(self):
+        return self._t0
+
+    @t0.setter
+    def t0(self, t0: float):
+        self._t0 = t0
+        # Message dates are compared as datetimes, as converting each one to a timestamp allocates
+        self._t0Date = dt.datetime.fromtimestamp(t0, tz=dt.timezone.utc)
+
+    def filterRecord(self, record):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Msg: %f, Bot start: %f", record.timestamp, self._t0)
+        return record.date > self._t0Date
+
+
+#%% Experimental admin privilege filter
+class AdminFilter(RecordFilter):
+    '''Prevents messages/commands sent by non-admins from being processed.'''
+    cost = 1
+
+    def __init__(self, id: int, *args, **kwargs):
+        self._id = id
+        super().__init__(*args, **kwargs)
+
+    @property
+    def id(self):
+        return self._id
+
+    def filterRecord(self, record):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Msg from: %s, Admin: %d", record.userId, self._id)
+        return record.userId == self._id
+
+
+class RoleFilter(RecordFilter):
+    '''
+    Prevents messages/commands sent by users without at least a given role (see roles.py) from being processed.
+    The roles are looked up on every message, so changes to them apply at once.
+    '''
+    cost = 1
+
+    def __init__(self, roles, role: str, *args, **kwargs):
+        self._roles = roles
+        self._role = role
+        super().__init__(*args, **kwargs)
+
+    @property
+    def role(self):
+        return self._role
+
+    def filterRecord(self, record):
+        return record.userId is not None and record.userId in self._roles.atLeast(self._role)
+
+
+#%% Context filtering
+class PrivateOnlyChatFilter(RecordFilter):
+    """
+    Filter that only allows messages sent to a private chat.
+    """
+    cost = 1
+
+    def filterRecord(self, record):
+        return record.chatType == constants.ChatType.PRIVATE
+    
+class GroupOnlyChatFilter(RecordFilter):
+    """
+    Filter that only allows messages sent to a group chat.
+    """
+    cost = 1
+
+    def filterRecord(self, record):
+        return record.chatType == constants.ChatType.GROUP
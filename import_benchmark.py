@@ -0,0 +1,58 @@
+#%% Cold-start benchmark for the package.
+# Each case is run in a fresh interpreter several times, and the wall time of the whole process
+# (interpreter startup included) is reported, along with the number of modules that ended up imported.
+# Run this from the folder containing common_bot_interfaces:
+#   python -m common_bot_interfaces.import_benchmark [repeats]
+#
+# The 'runner' case should stay close to the 'python' baseline, as it must not import telegram.
+
+import subprocess
+import statistics
+import sys
+import os
+import time
+
+GENERIC_BOT = """
+from common_bot_interfaces import *
+class GenericBot(GitInterface, SystemInterface, ControlInterface, StatusInterface, BotContainer):
+    pass
+bot = GenericBot.fromTokenString('123456:ABCDEF')
+bot.setAdmin(1)
+"""
+
+CASES = {
+    "python": "pass",
+    "runner": "import common_bot_interfaces.bot_runner",
+    "filters": "import common_bot_interfaces.filters",
+    "package": "import common_bot_interfaces",
+    "genericbot": GENERIC_BOT,
+}
+
+def measure(code: str, repeats: int=5, cwd: str=None):
+    """Returns (median seconds, number of modules loaded) for running some code in a fresh interpreter."""
+    script = code + "\nimport sys\nprint(len(sys.modules))\n"
+    times = []
+    modules = None
+    for _ in range(repeats):
+        t = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", script], cwd=cwd, capture_output=True, text=True, check=True)
+        times.append(time.perf_counter() - t)
+        modules = int(output.stdout.split()[-1])
+    return statistics.median(times), modules
+
+def main(repeats: int=5):
+    cwd = os.getcwd()
+    baseline = None
+    for name, code in CASES.items():
+        try:
+            seconds, modules = measure(code, repeats, cwd)
+        except subprocess.CalledProcessError as e:
+            print("%-12s failed: %s" % (name, e.stderr.strip().splitlines()[-1] if e.stderr.strip() else e))
+            continue
+        if baseline is None:
+            baseline = seconds
+        print("%-12s %8.1fms (+%7.1fms) %5d modules" % (name, seconds * 1000, (seconds - baseline) * 1000, modules))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
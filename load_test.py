@@ -0,0 +1,316 @@
+#%% Offline load test against a fake Telegram Bot API server.
+# A FakeBotApi serves getUpdates, sendMessage and the other calls a bot makes at startup from a local HTTP server,
+# and the bot is pointed at it through the baseUrl option of BotContainer. Synthetic updates (commands from admins
+# and non-admins, plain text, stale messages, private and group chats) are then fed through the bot as fast as it
+# takes them, or at a given rate, and we report:
+#   - updates per second, end to end (from the update being available to its processing finishing),
+#   - p50/p99 of that end-to-end latency, and the per-command handler metrics (see metrics.py),
+#   - the peak memory of the process.
+# No network access or real token is needed. Run this from the folder containing common_bot_interfaces:
+#   python -m common_bot_interfaces.load_test [--updates 5000] [--rate 0] [--concurrent 0] [--chats 100]
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import urllib.parse
+import logging
+
+try:
+    import resource
+except ImportError: # Not on Windows
+    resource = None
+
+from telegram import Update
+from telegram.ext import ContextTypes, TypeHandler
+
+try:
+    from .common_bot_interfaces import BotContainer, StatusInterface, AdminInterface, MetricsInterface, PrivateOnlyChatFilter, GroupOnlyChatFilter
+    from .outbound import OutboundQueue
+except ImportError: # Running this file directly as a script
+    from common_bot_interfaces import BotContainer, StatusInterface, AdminInterface, MetricsInterface, PrivateOnlyChatFilter, GroupOnlyChatFilter
+    from outbound import OutboundQueue
+
+logger = logging.getLogger(__name__)
+
+TOKEN = "123456:FAKE-TOKEN"
+BOT_ID = 123456
+ADMIN_ID = 1000
+
+class FakeBotApi:
+    """
+    Just enough of the Bot API, over HTTP on 127.0.0.1, for a bot to start, poll for updates and send messages.
+    Updates are queued with push(), and every sendMessage is counted.
+    """
+    def __init__(self, host: str="127.0.0.1", port: int=0):
+        self._host = host
+        self._port = port
+        self._server = None
+        self._updates = [] # Update dicts, in order of update_id
+        self._confirmed = 0 # Updates before this index have been confirmed by the bot
+        self._pushedAt = dict() # update_id -> time it was made available
+        self._newUpdates = asyncio.Event()
+        self._messageId = 0
+        self.sent = 0
+        self.requests = 0
+
+    @property
+    def port(self):
+        return self._port
+
+    @property
+    def baseUrl(self):
+        return "http://%s:%d/bot" % (self._host, self._port)
+
+    @property
+    def baseFileUrl(self):
+        return "http://%s:%d/file/bot" % (self._host, self._port)
+
+    def pushedAt(self, updateId: int):
+        return self._pushedAt.get(updateId)
+
+    def push(self, updates: list):
+        now = time.perf_counter()
+        for update in updates:
+            self._pushedAt[update["update_id"]] = now
+        self._updates.extend(updates)
+        self._newUpdates.set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self._host, self._port)
+        self._port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        # HTTP/1.1 with keep-alive, as the bot's client reuses its connections
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                lines = head.decode("latin-1").split("\r\n")
+                _, path, _ = lines[0].split(" ", 2)
+                headers = {k.strip().lower(): v.strip() for k, v in (l.split(":", 1) for l in lines[1:] if ":" in l)}
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                result = await self._call(path.rsplit("/", 1)[-1], self._params(headers.get("content-type", ""), body))
+                payload = json.dumps({"ok": True, "result": result}).encode()
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n" % len(payload) + payload)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _params(contentType: str, body: bytes):
+        if not body:
+            return dict()
+        if contentType.startswith("application/json"):
+            return json.loads(body)
+        params = dict()
+        for k, v in urllib.parse.parse_qsl(body.decode()):
+            try:
+                params[k] = json.loads(v)
+            except ValueError:
+                params[k] = v
+        return params
+
+    async def _call(self, method: str, params: dict):
+        self.requests += 1
+        if method == "getMe":
+            return {"id": BOT_ID, "is_bot": True, "first_name": "Fake", "username": "fake_bot",
+                    "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+        if method == "getUpdates":
+            return await self._getUpdates(int(params.get("offset", 0)), int(params.get("limit", 100)), float(params.get("timeout", 0)))
+        if method == "sendMessage":
+            self.sent += 1
+            self._messageId += 1
+            chatId = int(params["chat_id"])
+            return {"message_id": self._messageId, "date": int(time.time()), "text": params.get("text", ""),
+                    "chat": {"id": chatId, "type": "private" if chatId > 0 else "group", "title": "group"},
+                    "from": {"id": BOT_ID, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}}
+        return True # deleteWebhook, setMyCommands and the like
+
+    async def _getUpdates(self, offset: int, limit: int, timeout: float):
+        # Updates before the offset are confirmed, as with the real API
+        while self._confirmed < len(self._updates) and self._updates[self._confirmed]["update_id"] < offset:
+            self._confirmed += 1
+        if self._confirmed == len(self._updates) and timeout > 0:
+            self._newUpdates.clear()
+            try:
+                await asyncio.wait_for(self._newUpdates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[self._confirmed:self._confirmed + limit]
+
+
+class UpdateGenerator:
+    """
+    Makes synthetic update dictionaries. The mix is given as relative weights of each kind:
+    'status' (a public command), 'admin' (from the admin), 'denied' (an admin command from someone else),
+    'unknown' (a command nobody handles), 'text' (a plain message) and 'stale' (a /status sent before the bot started).
+    Group chats have negative IDs, as in Telegram.
+    """
+    DEFAULT_MIX = dict(status=4, admin=1, denied=1, unknown=1, text=2, stale=1)
+
+    def __init__(self, chats: int=100, groupFraction: float=0.3, mix: dict=None, seed: int=0):
+        self._chats = chats
+        self._groupFraction = groupFraction
+        mix = self.DEFAULT_MIX if mix is None else mix
+        self._kinds = list(mix)
+        self._weights = [mix[k] for k in self._kinds]
+        self._random = random.Random(seed)
+        self._updateId = 0
+
+    def _message(self, chatIndex: int, userId: int, text: str, date: int):
+        group = chatIndex < self._chats * self._groupFraction
+        chat = {"id": -(chatIndex + 1), "type": "group", "title": "Group %d" % chatIndex} if group else {"id": chatIndex + 1, "type": "private"}
+        message = {"message_id": self._updateId, "date": date, "chat": chat, "text": text,
+                   "from": {"id": userId, "is_bot": False, "first_name": "User%d" % userId}}
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return message
+
+    def generate(self, n: int, startTime: float):
+        """Makes n updates. Fresh ones are dated after startTime, and stale ones well before it."""
+        updates = []
+        fresh = int(startTime) + 1 # Dates are whole seconds; the AliveFilter needs them to be after the start
+        for kind in self._random.choices(self._kinds, self._weights, k=n):
+            self._updateId += 1
+            chatIndex = self._random.randrange(self._chats)
+            userId = ADMIN_ID if kind == "admin" else 2000 + chatIndex
+            text, date = {
+                "status": ("/status", fresh),
+                "admin": ("/admin", fresh),
+                "denied": ("/admin", fresh),
+                "unknown": ("/nosuchcommand", fresh),
+                "text": ("hello there", fresh),
+                "stale": ("/status", fresh - 3600),
+            }[kind]
+            updates.append({"update_id": self._updateId, "message": self._message(chatIndex, userId, text, date)})
+        return updates
+
+
+class LoadTestBot(MetricsInterface, StatusInterface, AdminInterface, BotContainer):
+    """A bot with the common interfaces and some cheap commands, whose replies are not rate limited."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The real limits would make the fake server the bottleneck
+        self._outbox = OutboundQueue(self._app.bot, globalRate=1e9, globalBurst=1e9, chatRate=1e9, chatBurst=1e9, metrics=self._metrics)
+
+    def _addInterfaceHandlers(self):
+        super()._addInterfaceHandlers()
+        self.addCommand('private', self.echo, filters=self.ufilts & PrivateOnlyChatFilter())
+        self.addCommand('group', self.echo, filters=self.ufilts & GroupOnlyChatFilter())
+
+    async def echo(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await self.reply(update, update.effective_message.text)
+
+
+def _peakMemoryMB():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # KB on Linux
+
+def _percentile(values: list, q: float):
+    return values[min(len(values) - 1, int(len(values) * q / 100))] if values else float("nan")
+
+async def runLoadTest(updates: int=5000, rate: float=0.0, concurrent: int=0, chats: int=100, batch: int=100, botClass=LoadTestBot):
+    """
+    Feeds updates through a bot against a FakeBotApi, and returns a dictionary of results.
+
+    Parameters
+    ----------
+    updates : int
+        Number of updates to send.
+    rate : float
+        Updates per second to make available. 0 makes them all available at once, which measures peak throughput.
+    concurrent : int
+        Passed to the bot as concurrentUpdates; 0 processes updates sequentially.
+    chats : int
+        Number of distinct chats.
+    batch : int
+        Updates made available at a time, when rate is given.
+    botClass : type
+        The BotContainer subclass to test. It is given ADMIN_ID as its admin if it has setAdmin().
+    """
+    api = FakeBotApi()
+    await api.start()
+    bot = botClass.fromTokenString(TOKEN, baseUrl=api.baseUrl, baseFileUrl=api.baseFileUrl,
+                                   concurrentUpdates=concurrent or None)
+    if hasattr(bot, "setAdmin"):
+        bot.setAdmin(ADMIN_ID)
+    app = bot._app
+
+    # As in BotContainer.run(), which we can't use as it runs its own event loop
+    bot.freezeFilters()
+    bot._addInterfaceHandlers()
+
+    latencies = []
+    done = asyncio.Event()
+    async def processed(update, context):
+        # In the last group, so this runs once every other group has handled the update
+        latencies.append(time.perf_counter() - api.pushedAt(update.update_id))
+        if len(latencies) == updates:
+            done.set()
+    app.add_handler(TypeHandler(Update, processed), group=1000)
+
+    await app.initialize()
+    await app.start()
+    await app.updater.start_polling(poll_interval=0.0, timeout=1)
+
+    generator = UpdateGenerator(chats=chats)
+    allUpdates = generator.generate(updates, time.time())
+    t0 = time.perf_counter()
+    if rate > 0:
+        for i in range(0, updates, batch):
+            api.push(allUpdates[i:i + batch])
+            await asyncio.sleep(batch / rate)
+    else:
+        api.push(allUpdates)
+    await done.wait()
+    elapsed = time.perf_counter() - t0
+
+    await app.updater.stop()
+    await bot.outbox.join()
+    await bot.outbox.stop()
+    await app.stop()
+    await app.shutdown()
+    await api.stop()
+
+    latencies.sort()
+    return dict(
+        updates=updates,
+        seconds=elapsed,
+        updatesPerSecond=updates / elapsed,
+        p50=_percentile(latencies, 50),
+        p99=_percentile(latencies, 99),
+        repliesSent=api.sent,
+        apiRequests=api.requests,
+        peakMemoryMB=_peakMemoryMB(),
+        commands=bot.metrics.report(),
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test of a bot against a fake Bot API server.")
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--rate", type=float, default=0.0, help="Updates per second; 0 sends them all at once")
+    parser.add_argument("--concurrent", type=int, default=0, help="concurrentUpdates for the bot; 0 is sequential")
+    parser.add_argument("--chats", type=int, default=100)
+    args = parser.parse_args()
+
+    results = asyncio.run(runLoadTest(args.updates, args.rate, args.concurrent, args.chats))
+    print("%d updates in %.2fs: %.0f updates/s" % (results["updates"], results["seconds"], results["updatesPerSecond"]))
+    print("End-to-end latency: p50 %.1fms, p99 %.1fms" % (results["p50"] * 1000, results["p99"] * 1000))
+    print("%d replies sent, %d API requests" % (results["repliesSent"], results["apiRequests"]))
+    if results["peakMemoryMB"] is not None:
+        print("Peak memory: %.1fMB" % results["peakMemoryMB"])
+    print(results["commands"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+#%% Per-command latency and throughput metrics.
+# The command router times how long each command spends in its filters and its handler, and the outbound queue
+# times the send_message() calls made on behalf of each command. Every timing goes into a Histogram for that
+# (command, stage) pair, which keeps:
+#   - cumulative bucket counts, a sum and a count, as for a Prometheus histogram, and
+#   - the most recent samples, for percentiles and a rate over a rolling window.
+#
+# The command being handled is tracked in the currentCommand context variable, which carries over to anything
+# the handler queues (see OutboundQueue.send()), so sends can be attributed to the command that made them.
+
+import asyncio
+import bisect
+import collections
+import contextvars
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+currentCommand = contextvars.ContextVar("currentCommand", default=None)
+
+STAGE_FILTER = "filter"
+STAGE_HANDLER = "handler"
+STAGE_API = "api"
+
+# Upper bounds of the buckets in seconds, roughly logarithmic from 100us to 30s
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Histogram:
+    """Latency histogram with cumulative buckets, plus a bounded window of recent samples."""
+    __slots__ = ('bounds', 'counts', 'sum', 'count', '_recent')
+
+    def __init__(self, bounds=DEFAULT_BUCKETS, recent: int=1000):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # The last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._recent = collections.deque(maxlen=recent) # (time, seconds)
+
+    def observe(self, seconds: float, now: float=None):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+        self._recent.append((time.monotonic() if now is None else now, seconds))
+
+    def percentile(self, q: float):
+        """Percentile (0 to 100) of the recent samples, or None if there are none."""
+        if len(self._recent) == 0:
+            return None
+        values = sorted(v for _, v in self._recent)
+        return values[min(len(values) - 1, int(len(values) * q / 100))]
+
+    def rate(self, window: float=60.0, now: float=None):
+        """
+        Samples per second over the last window seconds. If the recent samples do not go back that far, as older ones
+        have been dropped, it is over the time the recent samples cover instead.
+        """
+        now = time.monotonic() if now is None else now
+        n = 0
+        for t, _ in reversed(self._recent):
+            if now - t > window:
+                return n / window
+            n += 1
+        if n < self._recent.maxlen:
+            return n / window # Every sample in the window is still here
+        return n / max(now - self._recent[0][0], 1e-3)
+
+
+class Metrics:
+    """Histograms per (command, stage), where the stage is one of STAGE_FILTER, STAGE_HANDLER and STAGE_API."""
+    def __init__(self, bounds=DEFAULT_BUCKETS, recent: int=1000):
+        self._bounds = bounds
+        self._recentSize = recent
+        self._histograms = dict()
+
+    @property
+    def histograms(self):
+        return self._histograms
+
+    def observe(self, command: str, stage: str, seconds: float):
+        key = (command, stage)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram(self._bounds, self._recentSize)
+        histogram.observe(seconds)
+
+    def report(self, window: float=60.0):
+        """A plain text summary, one line per command and stage, with the slowest handlers first."""
+        handlerTime = {command: h.sum for (command, stage), h in self._histograms.items() if stage == STAGE_HANDLER}
+        keys = sorted(self._histograms, key=lambda k: (-handlerTime.get(k[0], 0.0), k[0], k[1]))
+        lines = []
+        for command, stage in keys:
+            h = self._histograms[(command, stage)]
+            lines.append("/%s %s: n=%d, %.2f/min, p50 %.1fms, p95 %.1fms, p99 %.1fms" % (
+                command, stage, h.count, h.rate(window) * 60,
+                h.percentile(50) * 1000, h.percentile(95) * 1000, h.percentile(99) * 1000))
+        return "\n".join(lines) if lines else "No commands handled yet."
+
+    def prometheus(self, prefix: str="bot_command"):
+        """The histograms in the Prometheus text exposition format."""
+        name = "%s_seconds" % prefix
+        lines = [
+            "# HELP %s Time spent per command, by stage (filter, handler, api)." % name,
+            "# TYPE %s histogram" % name,
+        ]
+        for (command, stage), h in sorted(self._histograms.items()):
+            labels = 'command="%s",stage="%s"' % (command.replace("\\", "\\\\").replace('"', '\\"'), stage)
+            cumulative = 0
+            for bound, n in zip(self._bounds, h.counts):
+                cumulative += n
+                lines.append('%s_bucket{%s,le="%g"} %d' % (name, labels, bound, cumulative))
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, labels, h.count))
+            lines.append('%s_sum{%s} %.9f' % (name, labels, h.sum))
+            lines.append('%s_count{%s} %d' % (name, labels, h.count))
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """
+    Minimal HTTP server which answers every GET with the metrics in the Prometheus text format.
+    Meant for a scraper on the same host, so it listens on 127.0.0.1 by default.
+    """
+    def __init__(self, metrics: Metrics, host: str="127.0.0.1", port: int=9464):
+        self._metrics = metrics
+        self._host = host
+        self._port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self._host, self._port)
+        logger.info("Serving metrics on http://%s:%d/metrics", self._host, self._port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5.0)
+            if request.startswith(b"GET "):
+                body = self._metrics.prometheus().encode()
+                status = b"200 OK"
+            else:
+                body = b""
+                status = b"405 Method Not Allowed"
+            writer.write(b"HTTP/1.1 " + status + b"\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: "
+                         + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,303 @@
+#%% Rate-limited outbound message queue.
+# Telegram limits bots to roughly 30 messages per second overall, and about 1 message per second per chat,
+# with 429 (RetryAfter) errors when bursts exceed that. Instead of every handler calling
+# bot.send_message() directly, replies are queued here and sent by a single worker task which:
+#   - keeps a token bucket per chat and one globally,
+#   - sends higher priority messages (e.g. admin/control replies) first,
+#   - coalesces consecutive queued messages to the same chat into one message where possible,
+#   - keeps messages to the same chat in order,
+#   - waits out and retries on RetryAfter.
+# If given a Metrics instance, the time taken by each send is recorded against the command which queued it.
+
+import asyncio
+import collections
+import itertools
+import logging
+
+from telegram.error import RetryAfter
+
+try:
+    from .metrics import currentCommand, STAGE_API
+except ImportError: # Running from the same folder as a script
+    from metrics import currentCommand, STAGE_API
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+MAX_MESSAGE_LENGTH = 4096
+
+class QueueStopped(Exception):
+    """Set on the futures of messages abandoned by OutboundQueue.stop()."""
+    pass
+
+class TokenBucket:
+    """Token bucket holding up to 'burst' tokens, refilled at 'rate' tokens per second."""
+    __slots__ = ('rate', 'burst', '_tokens', '_last', '_pausedUntil')
+
+    def __init__(self, rate: float, burst: float, now: float=0.0):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = now
+        self._pausedUntil = 0.0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def delay(self, now: float):
+        """Seconds until a token is available; 0 if one is available now."""
+        self._refill(now)
+        wait = 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+        return max(wait, self._pausedUntil - now)
+
+    def consume(self, now: float):
+        self._refill(now)
+        self._tokens -= 1
+
+    def pause(self, now: float, seconds: float):
+        """Blocks the bucket for some time, e.g. when told to retry after a number of seconds."""
+        self._pausedUntil = max(self._pausedUntil, now + seconds)
+
+    def full(self, now: float):
+        self._refill(now)
+        return self._tokens >= self.burst and self._pausedUntil <= now
+
+
+class _Outgoing:
+    __slots__ = ('chatId', 'text', 'priority', 'seq', 'kwargs', 'futures', 'command')
+
+    def __init__(self, chatId, text, priority, seq, kwargs, future, command=None):
+        self.command = command
+        self.chatId = chatId
+        self.text = text
+        self.priority = priority
+        self.seq = seq
+        self.kwargs = kwargs
+        self.futures = [future]
+
+
+class OutboundQueue:
+    """
+    Queue of outgoing messages for a bot, drained by a single worker task.
+    The worker is started on the first send(), so this must be used from within the bot's event loop.
+    """
+    def __init__(self, bot, globalRate: float=30.0, globalBurst: float=30.0,
+                 chatRate: float=1.0, chatBurst: float=3.0,
+                 coalesce: bool=True, maxInFlight: int=8, metrics=None):
+        """
+        Parameters
+        ----------
+        bot : telegram.Bot
+            The bot used to send the messages.
+        globalRate, globalBurst : float
+            Messages per second, and burst size, across all chats.
+        chatRate, chatBurst : float
+            Messages per second, and burst size, for each chat.
+        coalesce : bool
+            Joins consecutive queued messages to the same chat with the same priority and
+            options into one message, as long as it fits within Telegram's message length limit.
+        maxInFlight : int
+            Maximum number of send requests in flight at once (always at most one per chat).
+        metrics : Metrics
+            Records the time taken by each send, against the command being handled when it was queued.
+        """
+        self._bot = bot
+        self._globalBucket = TokenBucket(globalRate, globalBurst)
+        self._chatRate = chatRate
+        self._chatBurst = chatBurst
+        self._chatBuckets = dict()
+        self._coalesce = coalesce
+        self._maxInFlight = maxInFlight
+        self._metrics = metrics
+
+        self._pending = dict() # chatId -> deque of _Outgoing
+        self._inflight = set() # chatIds with a send in progress
+        self._sends = set() # Tasks of the sends in progress
+        self._seq = itertools.count()
+        self._count = 0
+        self._worker = None
+        self._wake = None
+        self._idle = None
+
+    @property
+    def pending(self):
+        """Number of messages waiting to be sent, after coalescing."""
+        return self._count
+
+    def send(self, chatId: int, text: str, priority: int=PRIORITY_NORMAL, logFailures: bool=True, **kwargs):
+        """
+        Queues a message. Extra keyword arguments are passed to bot.send_message().
+        Returns a future for the sent telegram.Message. Failures are logged as errors, unless logFailures is False,
+        for callers which handle them themselves.
+        """
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done():
+            self._wake = asyncio.Event()
+            self._idle = asyncio.Event()
+            self._worker = loop.create_task(self._run(), name="OutboundQueue")
+        self._idle.clear()
+
+        future = loop.create_future()
+        if logFailures:
+            future.add_done_callback(self._logFailure)
+
+        q = self._pending.get(chatId)
+        if q is None:
+            q = self._pending[chatId] = collections.deque()
+        last = q[-1] if q else None
+        if (
+            self._coalesce
+            and last is not None
+            and last.priority == priority
+            and last.kwargs == kwargs
+            and len(last.text) + 1 + len(text) <= MAX_MESSAGE_LENGTH
+        ):
+            last.text += "\n" + text
+            last.futures.append(future)
+        else:
+            q.append(_Outgoing(chatId, text, priority, next(self._seq), kwargs, future, currentCommand.get()))
+            self._count += 1
+
+        self._wake.set()
+        return future
+
+    async def join(self):
+        """Waits until every queued message has been sent (or has failed)."""
+        if self._worker is None or self._worker.done():
+            return
+        await self._idle.wait()
+
+    async def stop(self):
+        """
+        Stops the worker task and the sends in progress, abandoning anything still queued.
+        The futures of abandoned messages fail with QueueStopped, so nothing waits on them forever.
+        """
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        sends = list(self._sends)
+        for task in sends:
+            task.cancel()
+        if sends:
+            await asyncio.gather(*sends, return_exceptions=True)
+
+        pending, self._pending = self._pending, dict()
+        self._count = 0
+        for q in pending.values():
+            for item in q:
+                self._abandon(item)
+
+    @staticmethod
+    def _abandon(item: _Outgoing):
+        for future in item.futures:
+            if not future.done():
+                future.set_exception(QueueStopped("The message was not sent before the queue stopped."))
+
+    def _chatBucket(self, chatId, now):
+        bucket = self._chatBuckets.get(chatId)
+        if bucket is None:
+            # Forget buckets of idle chats every so often, so this doesn't grow without bound
+            if len(self._chatBuckets) > 10000:
+                self._chatBuckets = {
+                    k: b for k, b in self._chatBuckets.items()
+                    if k in self._pending or k in self._inflight or not b.full(now)
+                }
+            bucket = self._chatBuckets[chatId] = TokenBucket(self._chatRate, self._chatBurst, now)
+        return bucket
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._pending:
+                if not self._inflight:
+                    self._idle.set()
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+
+            now = loop.time()
+            best = None
+            wait = None
+            if len(self._inflight) < self._maxInFlight:
+                for chatId, q in self._pending.items():
+                    if chatId in self._inflight:
+                        continue
+                    chatWait = self._chatBucket(chatId, now).delay(now)
+                    if chatWait > 0:
+                        wait = chatWait if wait is None else min(wait, chatWait)
+                        continue
+                    head = q[0]
+                    if best is None or (head.priority, head.seq) < (best.priority, best.seq):
+                        best = head
+
+            globalWait = self._globalBucket.delay(now)
+            if best is None or globalWait > 0:
+                if best is not None:
+                    wait = globalWait
+                # Sleep until a bucket refills, or until something else is queued or a send completes
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            q = self._pending[best.chatId]
+            q.popleft()
+            if not q:
+                del self._pending[best.chatId]
+            self._count -= 1
+            self._globalBucket.consume(now)
+            self._chatBucket(best.chatId, now).consume(now)
+            self._inflight.add(best.chatId)
+            task = loop.create_task(self._send(best))
+            self._sends.add(task)
+            task.add_done_callback(self._sends.discard)
+
+    async def _send(self, item: _Outgoing):
+        loop = asyncio.get_running_loop()
+        t = loop.time()
+        try:
+            message = await self._bot.send_message(chat_id=item.chatId, text=item.text, **item.kwargs)
+        except RetryAfter as e:
+            retryAfter = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+            logger.warning("Flood limit hit sending to %s, retrying after %.1fs", item.chatId, retryAfter)
+            now = loop.time()
+            self._chatBucket(item.chatId, now).pause(now, retryAfter)
+            self._globalBucket.pause(now, retryAfter)
+            # Put it back at the front, so ordering within the chat is kept
+            q = self._pending.get(item.chatId)
+            if q is None:
+                q = self._pending[item.chatId] = collections.deque()
+            q.appendleft(item)
+            self._count += 1
+        except asyncio.CancelledError:
+            self._abandon(item)
+            raise
+        except Exception as e:
+            for future in item.futures:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for future in item.futures:
+                if not future.done():
+                    future.set_result(message)
+        finally:
+            if self._metrics is not None and item.command is not None:
+                self._metrics.observe(item.command, STAGE_API, loop.time() - t)
+            self._inflight.discard(item.chatId)
+            self._wake.set()
+
+    @staticmethod
+    def _logFailure(future):
+        # Abandoned messages are counted by whoever stopped the queue
+        if not future.cancelled() and future.exception() is not None and not isinstance(future.exception(), QueueStopped):
+            logger.error("Failed to send message: %r", future.exception())
@@ -0,0 +1,86 @@
+#%% Caching of method results for idempotent commands.
+# Decorate the method which does the work (e.g. running git, or reading a file) rather than the handler itself,
+# so that the handler still replies to each update:
+#
+#   @cached(ttl=60, group="git")
+#   async def _gitLog(self):
+#       ...
+#
+# Results are cached per instance and per arguments, for ttl seconds, and a group of methods can be invalidated
+# at once with invalidate(self, "git"), e.g. after a git pull. Concurrent calls of an async method with the same
+# arguments share a single call, so a burst of /gitlog runs git once. The shared call runs as a task of its own,
+# so cancelling the caller which started it does not cancel it for the others. Results which should not be kept,
+# e.g. failures, can be left out with cacheIf.
+
+import asyncio
+import functools
+import inspect
+import time
+
+_CACHE_ATTR = "_responseCache"
+
+def _cache(obj):
+    cache = obj.__dict__.get(_CACHE_ATTR)
+    if cache is None:
+        cache = obj.__dict__[_CACHE_ATTR] = dict() # (group, name, args) -> (expires, value or future)
+    return cache
+
+def cached(ttl: float=30.0, group: str=None, cacheIf=None):
+    """
+    Decorator which caches a method's result for ttl seconds. Arguments must be hashable.
+    The group defaults to the method's name; see invalidate(). If given, cacheIf is called with each result,
+    which is only cached if it returns True; concurrent calls still share the result.
+    """
+    def decorator(fn):
+        name = fn.__qualname__
+        g = name if group is None else group
+
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(self, *args, **kwargs):
+                cache = _cache(self)
+                key = (g, name, args, tuple(sorted(kwargs.items())))
+                entry = cache.get(key)
+                if entry is not None and entry[0] > time.monotonic():
+                    return await asyncio.shield(entry[1])
+
+                task = asyncio.get_running_loop().create_task(fn(self, *args, **kwargs))
+                cache[key] = (float("inf"), task) # Until it completes, so concurrent calls wait for this one
+
+                def done(task):
+                    if cache.get(key, (None, None))[1] is not task: # Invalidated meanwhile
+                        return
+                    # The exception is retrieved here, so it isn't reported when nobody was waiting any more
+                    if task.cancelled() or task.exception() is not None or (cacheIf is not None and not cacheIf(task.result())):
+                        del cache[key]
+                    else:
+                        cache[key] = (time.monotonic() + ttl, task)
+                task.add_done_callback(done)
+                return await asyncio.shield(task)
+        else:
+            @functools.wraps(fn)
+            def wrapper(self, *args, **kwargs):
+                cache = _cache(self)
+                key = (g, name, args, tuple(sorted(kwargs.items())))
+                entry = cache.get(key)
+                if entry is not None and entry[0] > time.monotonic():
+                    return entry[1]
+                value = fn(self, *args, **kwargs)
+                if cacheIf is None or cacheIf(value):
+                    cache[key] = (time.monotonic() + ttl, value)
+                return value
+
+        return wrapper
+    return decorator
+
+def invalidate(obj, group: str=None):
+    """Drops an object's cached results for a group, or all of them if group is None. Returns the number dropped."""
+    cache = _cache(obj)
+    if group is None:
+        n = len(cache)
+        cache.clear()
+        return n
+    keys = [k for k in cache if k[0] == group]
+    for k in keys:
+        del cache[k]
+    return len(keys)
@@ -0,0 +1,92 @@
+#%% User roles for access control.
+# Roles are ranked: admins can do everything operators can, and operators everything read-only users can.
+# For every role, the registry keeps a frozenset of the user IDs with at least that role, so a RoleFilter
+# only does one dictionary and one set lookup per message. Updating the roles builds new sets and swaps them in
+# at once, so they can be changed (e.g. reloaded from their file) while the bot is running.
+#
+# Roles are loaded from JSON, either a file or an environment variable, e.g.
+#   {"admins": [12345], "operators": [23456, 34567], "readonly": [45678]}
+
+import json
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+ROLE_ADMIN = "admins"
+ROLE_OPERATOR = "operators"
+ROLE_READONLY = "readonly"
+ROLES = (ROLE_ADMIN, ROLE_OPERATOR, ROLE_READONLY) # Highest first
+
+class Roles:
+    """Registry of which users have which role."""
+    def __init__(self):
+        self._members = {role: frozenset() for role in ROLES} # Users with exactly that role
+        self._atLeast = {role: frozenset() for role in ROLES} # Users with that role or a higher one
+        self._path = None
+
+    @property
+    def path(self):
+        """The file the roles were last loaded from, if any."""
+        return self._path
+
+    def members(self, role: str):
+        """Users with exactly this role."""
+        return self._members[role]
+
+    def atLeast(self, role: str):
+        """Users with this role or a higher one."""
+        return self._atLeast[role]
+
+    def roleOf(self, userId: int):
+        """The highest role of a user, or None."""
+        for role in ROLES:
+            if userId in self._members[role]:
+                return role
+        return None
+
+    def set(self, role: str, ids):
+        """Replaces the users with a role."""
+        if role not in ROLES:
+            raise ValueError("Unknown role %s; use one of %s." % (role, ", ".join(ROLES)))
+        members = dict(self._members)
+        members[role] = frozenset(int(i) for i in ids)
+        self._swap(members)
+
+    def add(self, role: str, userId: int):
+        self.set(role, self._members[role] | {userId})
+
+    def update(self, data: dict):
+        """Replaces all roles from a dictionary of role -> list of user IDs; roles which are missing are emptied."""
+        unknown = set(data) - set(ROLES)
+        if unknown:
+            raise ValueError("Unknown role(s) %s; use %s." % (", ".join(sorted(unknown)), ", ".join(ROLES)))
+        self._swap({role: frozenset(int(i) for i in data.get(role, ())) for role in ROLES})
+
+    def load(self, path: str=None):
+        """Loads the roles from a JSON file. Without a path, reloads the file that was loaded last."""
+        path = self._path if path is None else path
+        if path is None:
+            raise ValueError("No roles file to load.")
+        with open(path) as f:
+            self.update(json.load(f))
+        self._path = path
+        logger.info("Loaded roles from %s: %s", path, self.summary())
+
+    def loadFromEnvVar(self, envVar: str):
+        """Loads the roles from an environment variable containing JSON."""
+        self.update(json.loads(os.environ[envVar]))
+        logger.info("Loaded roles from $%s: %s", envVar, self.summary())
+
+    def summary(self):
+        return ", ".join("%d %s" % (len(self._members[role]), role) for role in ROLES)
+
+    def _swap(self, members: dict):
+        atLeast = dict()
+        above = frozenset()
+        for role in ROLES:
+            above = above | members[role]
+            atLeast[role] = above
+        # Each assignment is atomic; a filter running in between sees either the old or the new sets
+        self._members = members
+        self._atLeast = atLeast
@@ -0,0 +1,306 @@
+#%% Periodic jobs for the bots, e.g. health pings and digest messages, used by the SchedulerInterface.
+# Jobs run on the bot's event loop, on a fixed interval or a cron schedule, with:
+#   - coalescing: however many runs were missed (the bot was down, or the loop fell behind), a job runs once
+#     to catch up, and then carries on with its schedule. Given a StateStore, the last run of each job is saved,
+#     so this also holds across restarts by the BotRunner,
+#   - no overlap: a run which comes due while the previous run of the same job is still going is skipped,
+#   - a bound on the number of jobs running at once,
+#   - a record of every job's run durations and failures, for /status.
+#
+# Cron schedules take the usual 5 fields, "minute hour day-of-month month day-of-week", each of which may be
+# *, a number, a range (1-5), a list (1,15) or a step (*/10, 0-30/5), in local time. Sunday is 0 (or 7).
+
+import asyncio
+import datetime as dt
+import inspect
+import time
+import logging
+
+try:
+    from .executors import executors as sharedExecutors, THREAD
+except ImportError: # Running from the same folder as a script
+    from executors import executors as sharedExecutors, THREAD
+
+logger = logging.getLogger(__name__)
+
+class Cron:
+    """A cron schedule; see the top of this file for the format."""
+    _RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError("Cron schedule %r must have 5 fields: minute hour day-of-month month day-of-week." % expression)
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            self._parse(field, lo, hi) for field, (lo, hi) in zip(fields, self._RANGES))
+        self.weekdays = frozenset(d % 7 for d in self.weekdays)
+        # As in cron, if both days of the month and of the week are restricted, either may match
+        self._anyDay = fields[2] == "*" or fields[4] == "*"
+
+    @staticmethod
+    def _parse(field: str, lo: int, hi: int):
+        values = set()
+        for part in field.split(","):
+            rangePart, _, step = part.partition("/")
+            if rangePart == "*":
+                start, end = lo, hi
+            elif "-" in rangePart:
+                start, end = (int(v) for v in rangePart.split("-", 1))
+            else:
+                start = end = int(rangePart)
+                if step:
+                    end = hi
+            if not lo <= start <= end <= hi:
+                raise ValueError("Cron field %r is out of range %d-%d." % (field, lo, hi))
+            values.update(range(start, end + 1, int(step) if step else 1))
+        return frozenset(values)
+
+    def _dayMatches(self, t: dt.datetime):
+        inMonth = t.day in self.days
+        inWeek = (t.weekday() + 1) % 7 in self.weekdays
+        if self._anyDay:
+            return inMonth and inWeek
+        return inMonth or inWeek
+
+    def next(self, after: float):
+        """The first time matching the schedule strictly after a given time, as a timestamp."""
+        t = dt.datetime.fromtimestamp(after).replace(second=0, microsecond=0) + dt.timedelta(minutes=1)
+        limit = t + dt.timedelta(days=366 * 5)
+        while t < limit:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + dt.timedelta(days=32)).replace(day=1)
+            elif not self._dayMatches(t):
+                t = t.replace(hour=0, minute=0) + dt.timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + dt.timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += dt.timedelta(minutes=1)
+            else:
+                return t.timestamp()
+        raise ValueError("Cron schedule %r never matches." % self.expression)
+
+    def __repr__(self):
+        return "Cron(%r)" % self.expression
+
+
+class Job:
+    """A scheduled job, with statistics of its runs."""
+    def __init__(self, name: str, callback, interval: float=None, cron: str=None, firstDelay: float=None):
+        if (interval is None) == (cron is None):
+            raise ValueError("Job %s needs either an interval or a cron schedule." % name)
+        if interval is not None and interval <= 0:
+            raise ValueError("Job %s needs a positive interval." % name)
+        self.name = name
+        self.callback = callback
+        self.interval = interval
+        self.cron = None if cron is None else Cron(cron)
+        self.firstDelay = firstDelay
+        self.nextRun = None # Timestamp
+        self.lastRun = None
+        self.running = False
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0 # Came due while still running
+        self.coalesced = 0 # Missed runs folded into one
+        self.lastDuration = None
+        self.maxDuration = 0.0
+        self.totalDuration = 0.0
+
+    def nextAfter(self, t: float):
+        if self.interval is not None:
+            return t + self.interval
+        return self.cron.next(t)
+
+    def missedSince(self, lastRun: float, now: float):
+        """Number of runs due between a last run and now."""
+        if self.interval is not None:
+            return max(0, int((now - lastRun) // self.interval))
+        n = 0
+        t = self.cron.next(lastRun)
+        while t <= now and n < 1000: # Only for reporting, so a rough count will do for long outages
+            n += 1
+            t = self.cron.next(t)
+        return n
+
+    @property
+    def schedule(self):
+        return "every %gs" % self.interval if self.interval is not None else "cron '%s'" % self.cron.expression
+
+
+class Scheduler:
+    """Runs jobs on intervals or cron schedules on the event loop; see the top of this file."""
+    def __init__(self, maxConcurrent: int=4, executors=None):
+        """
+        Parameters
+        ----------
+        maxConcurrent : int
+            Maximum number of jobs running at once. Jobs due beyond that wait for one to finish.
+        executors : Executors
+            Pools to run jobs which are plain (not async) functions in; see executors.py. Defaults to the shared one.
+        """
+        self._jobs = dict()
+        self._maxConcurrent = maxConcurrent
+        self._executors = sharedExecutors if executors is None else executors
+        self._store = None
+        self._namespace = None
+        self._semaphore = None
+        self._worker = None
+        self._wakeup = None
+        self._runs = set()
+
+    @property
+    def jobs(self):
+        return self._jobs
+
+    def setMaxConcurrent(self, maxConcurrent: int):
+        """Must be called before start()."""
+        self._maxConcurrent = maxConcurrent
+
+    def add(self, name: str, callback, interval: float=None, cron: str=None, firstDelay: float=None):
+        """
+        Adds a job, replacing any job of the same name. Jobs added after start() are scheduled at once.
+
+        Parameters
+        ----------
+        name : str
+            Unique name of the job, under which its last run is saved.
+        callback : callable
+            Called with no arguments. Async functions run on the event loop, and others in the thread pool.
+        interval : float
+            Seconds between runs.
+        cron : str
+            Cron schedule, instead of an interval.
+        firstDelay : float
+            Seconds until the first run of an interval job which has never run. Defaults to the interval.
+        """
+        job = Job(name, callback, interval=interval, cron=cron, firstDelay=firstDelay)
+        self._jobs[name] = job
+        if self._worker is not None:
+            self._wakeup.set()
+        return job
+
+    def remove(self, name: str):
+        return self._jobs.pop(name, None)
+
+    async def start(self, store=None, namespace: str="scheduler"):
+        """
+        Schedules every job and starts running them. Given a StateStore, the last run of each job is loaded from and
+        saved to it, so that a job which missed runs while the bot was down runs once now, rather than waiting.
+        """
+        self._store = store
+        self._namespace = namespace
+        self._semaphore = asyncio.Semaphore(self._maxConcurrent)
+        self._wakeup = asyncio.Event()
+        now = time.time()
+        for job in self._jobs.values():
+            await self._schedule(job, now)
+        self._worker = asyncio.get_running_loop().create_task(self._loop(), name="Scheduler")
+        if self._jobs:
+            logger.info("Scheduled %d job(s): %s", len(self._jobs), ", ".join(self._jobs))
+
+    async def stop(self):
+        """Stops scheduling, and cancels the jobs still running."""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        for task in list(self._runs):
+            task.cancel()
+        if self._runs:
+            await asyncio.gather(*self._runs, return_exceptions=True)
+
+    async def _schedule(self, job: Job, now: float):
+        lastRun = None
+        if self._store is not None:
+            lastRun = await self._store.get(0, job.name, namespace=self._namespace)
+        if lastRun is None:
+            # Never run before
+            job.nextRun = now + job.firstDelay if job.interval is not None and job.firstDelay is not None else job.nextAfter(now)
+            return
+        job.lastRun = lastRun
+        missed = job.missedSince(lastRun, now)
+        if missed > 0:
+            job.nextRun = now
+            job.coalesced += missed - 1
+            if missed > 1:
+                logger.info("Job %s missed %d runs since it last ran; running it once now", job.name, missed)
+        else:
+            job.nextRun = job.nextAfter(lastRun)
+
+    async def _loop(self):
+        while True:
+            now = time.time()
+            for job in list(self._jobs.values()):
+                if job.nextRun is None:
+                    await self._schedule(job, now) # Added after start()
+                if job.nextRun > now:
+                    continue
+                # Whatever was missed is coalesced into this one run, and the schedule carries on from now
+                missed = job.missedSince(job.nextRun, now)
+                job.coalesced += missed
+                job.nextRun = job.nextAfter(now if missed > 0 else job.nextRun)
+                if job.nextRun <= now:
+                    job.nextRun = job.nextAfter(now)
+                if job.running:
+                    job.skipped += 1
+                    logger.info("Job %s is still running, skipping this run", job.name)
+                    continue
+                job.running = True
+                task = asyncio.get_running_loop().create_task(self._run(job), name="Job %s" % job.name)
+                self._runs.add(task)
+                task.add_done_callback(self._runs.discard)
+
+            nextRun = min((job.nextRun for job in self._jobs.values() if job.nextRun is not None), default=None)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), None if nextRun is None else max(0.0, nextRun - time.time()))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run(self, job: Job):
+        try:
+            async with self._semaphore:
+                started = time.time()
+                t = time.perf_counter()
+                try:
+                    if inspect.iscoroutinefunction(job.callback):
+                        await job.callback()
+                    else:
+                        await self._executors.run(THREAD, job.callback)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    job.failures += 1
+                    logger.exception("Job %s failed", job.name)
+                duration = time.perf_counter() - t
+                job.runs += 1
+                job.lastDuration = duration
+                job.maxDuration = max(job.maxDuration, duration)
+                job.totalDuration += duration
+                job.lastRun = started
+                if self._store is not None:
+                    self._store.set(0, job.name, started, namespace=self._namespace)
+        finally:
+            job.running = False
+
+    def report(self):
+        """One line per job, with its schedule, runs and durations."""
+        now = time.time()
+        lines = []
+        for job in self._jobs.values():
+            text = "%s (%s): %d run(s), %d failed" % (job.name, job.schedule, job.runs, job.failures)
+            if job.runs > 0:
+                text += ", last %.1fms, mean %.1fms, max %.1fms" % (
+                    job.lastDuration * 1000, job.totalDuration / job.runs * 1000, job.maxDuration * 1000)
+            if job.running:
+                text += ", running"
+            elif job.nextRun is not None:
+                text += ", next in %.0fs" % max(0.0, job.nextRun - now)
+            if job.skipped or job.coalesced:
+                text += ", %d skipped while running, %d missed run(s) coalesced" % (job.skipped, job.coalesced)
+            lines.append(text)
+        return "\n".join(lines)
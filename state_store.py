@@ -0,0 +1,202 @@
+#%% Persistent per-chat key-value state for the interfaces.
+# Values are kept in SQLite, so they survive restarts, with an in-memory LRU cache in front of it:
+#   - reads are served from the cache where possible, and only go to the database on a miss,
+#   - writes go to the cache at once, and are written to the database in batches by a background task
+#     (write-behind), so handlers never wait on the disk to save something,
+#   - values may have a time-to-live, after which they read as missing and are purged from the database.
+# All database work happens on one dedicated thread, so the event loop never blocks on SQLite.
+#
+# Values must be JSON-serialisable. Keys are (namespace, chat ID, key); the namespace lets mixins keep their
+# state apart, e.g. store.set(chatId, "lang", "en", namespace="MyInterface").
+
+import asyncio
+import collections
+import concurrent.futures
+import json
+import sqlite3
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+_DELETED = object()
+
+class StateStore:
+    """Key-value state per chat, in SQLite behind an LRU cache with write-behind batching and TTLs."""
+    def __init__(self, path: str, cacheSize: int=10000, flushInterval: float=1.0, purgeInterval: float=600.0):
+        """
+        Parameters
+        ----------
+        path : str
+            SQLite database file; created if it does not exist.
+        cacheSize : int
+            Maximum number of entries kept in memory, including remembered misses.
+        flushInterval : float
+            Seconds between writes of pending changes to the database.
+        purgeInterval : float
+            Seconds between deletions of expired rows from the database.
+        """
+        self._path = path
+        self._cacheSize = cacheSize
+        self._flushInterval = flushInterval
+        self._purgeInterval = purgeInterval
+        self._cache = collections.OrderedDict() # key -> (value, expires); value may be _MISSING
+        self._dirty = dict() # key -> (value, expires); value may be _DELETED
+        self._flushing = dict() # The batch being written
+        self._db = None
+        self._thread = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="state-store")
+        self._worker = None
+        self._lastPurge = time.time()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0 # Rows written to the database
+        self.flushes = 0
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def cached(self):
+        return len(self._cache)
+
+    @property
+    def pending(self):
+        """Changes not yet written to the database."""
+        return len(self._dirty)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses, hitRate=self.hits / total if total else 0.0,
+                    cached=self.cached, pending=self.pending, writes=self.writes, flushes=self.flushes)
+
+    async def get(self, chatId: int, key: str, default=None, namespace: str=""):
+        k = (namespace, chatId, key)
+        now = time.time()
+        entry = self._cache.get(k)
+        if entry is None:
+            # Evicted from the cache before being written
+            entry = self._dirty.get(k) or self._flushing.get(k)
+        if entry is not None:
+            self.hits += 1
+            self._remember(k, entry) # Which also evicts, if it came back from _dirty or _flushing
+        else:
+            self.misses += 1
+            entry = await self._run(self._load, k)
+            # Set while we were reading. A flush started since then is queued behind the read on the store's thread,
+            # so the value is still in _flushing, if not in _dirty
+            entry = self._dirty.get(k) or self._flushing.get(k) or entry
+            self._remember(k, entry)
+
+        value, expires = entry
+        if value is _MISSING or value is _DELETED or (expires is not None and expires <= now):
+            return default
+        return value
+
+    def set(self, chatId: int, key: str, value, ttl: float=None, namespace: str=""):
+        """Sets a value, optionally expiring after ttl seconds. Must be called from the event loop."""
+        json.dumps(value) # Fail now, rather than in the background
+        self._write((namespace, chatId, key), (value, None if ttl is None else time.time() + ttl))
+
+    def delete(self, chatId: int, key: str, namespace: str=""):
+        self._write((namespace, chatId, key), (_DELETED, None))
+
+    async def flush(self):
+        """Writes all pending changes to the database now."""
+        if not self._dirty:
+            return
+        batch, self._dirty = self._dirty, dict()
+        self._flushing = batch
+        try:
+            await self._run(self._store, batch)
+        except Exception:
+            # Put them back, unless they have been changed since
+            for k, entry in batch.items():
+                self._dirty.setdefault(k, entry)
+            raise
+        finally:
+            self._flushing = dict()
+        self.writes += len(batch)
+        self.flushes += 1
+
+    async def close(self):
+        """Stops the background task, flushes pending changes and closes the database."""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        await self.flush()
+        await self._run(self._close)
+        self._thread.shutdown(wait=True)
+
+    def _write(self, k, entry):
+        self._dirty[k] = entry
+        self._remember(k, entry)
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.get_running_loop().create_task(self._flushLoop(), name="StateStore")
+
+    def _remember(self, k, entry):
+        self._cache[k] = entry
+        self._cache.move_to_end(k)
+        while len(self._cache) > self._cacheSize:
+            self._cache.popitem(last=False)
+
+    async def _flushLoop(self):
+        while True:
+            await asyncio.sleep(self._flushInterval)
+            try:
+                await self.flush()
+                if time.time() - self._lastPurge >= self._purgeInterval:
+                    self._lastPurge = time.time()
+                    await self._run(self._purge)
+            except Exception:
+                logger.exception("Failed to write state to %s", self._path)
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._thread, fn, *args)
+
+    # Everything below runs on the store's thread
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self._path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS state ("
+                "namespace TEXT NOT NULL, chat INTEGER NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expires REAL, "
+                "PRIMARY KEY (namespace, chat, key))"
+            )
+        return self._db
+
+    def _load(self, k):
+        row = self._connect().execute(
+            "SELECT value, expires FROM state WHERE namespace=? AND chat=? AND key=?", k).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return _MISSING, None
+        return json.loads(row[0]), row[1]
+
+    def _store(self, batch: dict):
+        db = self._connect()
+        with db:
+            db.executemany(
+                "INSERT OR REPLACE INTO state (namespace, chat, key, value, expires) VALUES (?, ?, ?, ?, ?)",
+                [(*k, json.dumps(value), expires) for k, (value, expires) in batch.items() if value is not _DELETED])
+            db.executemany(
+                "DELETE FROM state WHERE namespace=? AND chat=? AND key=?",
+                [k for k, (value, _) in batch.items() if value is _DELETED])
+
+    def _purge(self):
+        db = self._connect()
+        with db:
+            n = db.execute("DELETE FROM state WHERE expires IS NOT NULL AND expires <= ?", (time.time(),)).rowcount
+        if n > 0:
+            logger.debug("Purged %d expired state entries", n)
+
+    def _close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -0,0 +1,170 @@
+#%% Asynchronous subprocess execution, shared by the interfaces that run external commands.
+# Commands are run with asyncio subprocesses, so the event loop (and therefore every other chat)
+# keeps going while they run. Output is streamed back in chunks through an async callback,
+# e.g. one which sends each chunk as a message.
+
+import asyncio
+import codecs
+import os
+import signal
+import logging
+
+logger = logging.getLogger(__name__)
+
+class SubprocessRunner:
+    """
+    Runs commands as asyncio subprocesses, with a limit on how many may run at once,
+    a default timeout, and the ability to cancel everything that is running.
+    """
+    def __init__(self, maxConcurrent: int=4, timeout: float=600.0, chunkSize: int=3500, flushInterval: float=2.0):
+        """
+        Parameters
+        ----------
+        maxConcurrent : int
+            Maximum number of commands running at once; further commands wait their turn.
+        timeout : float
+            Default timeout in seconds for each command, after which it is killed.
+        chunkSize : int
+            Maximum number of characters per output chunk. Telegram messages are limited to 4096.
+        flushInterval : float
+            Output is flushed at least this often (in seconds) while a command is producing output.
+        """
+        self._semaphore = asyncio.Semaphore(maxConcurrent)
+        self._timeout = timeout
+        self._chunkSize = chunkSize
+        self._flushInterval = flushInterval
+        self._procs = set()
+        self._waiting = 0
+
+    @property
+    def running(self):
+        return len(self._procs)
+
+    @property
+    def waiting(self):
+        return self._waiting
+
+    async def run(self, cmd, shell: bool=False, timeout: float=None, onOutput=None, cwd: str=None):
+        """
+        Runs a command to completion and returns its return code.
+
+        Parameters
+        ----------
+        cmd : str or list of str
+            The command. Must be a string if shell is True, and a list of arguments otherwise.
+        shell : bool
+            Runs the command through the shell.
+        timeout : float
+            Overrides the default timeout. On timeout the command is killed and asyncio.TimeoutError is raised.
+        onOutput : coroutine function
+            Called with each chunk of combined stdout/stderr as a string. Output is discarded if None.
+        cwd : str
+            Working directory for the command.
+        """
+        timeout = self._timeout if timeout is None else timeout
+        self._waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self._waiting -= 1
+
+        try:
+            kwargs = dict(
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT,
+                stdin=asyncio.subprocess.DEVNULL,
+                cwd=cwd,
+            )
+            # A separate session lets us kill everything a shell command spawned
+            if os.name == 'posix':
+                kwargs['start_new_session'] = True
+
+            logger.debug("Running %s", cmd)
+            if shell:
+                proc = await asyncio.create_subprocess_shell(cmd, **kwargs)
+            else:
+                proc = await asyncio.create_subprocess_exec(*cmd, **kwargs)
+
+            self._procs.add(proc)
+            try:
+                await asyncio.wait_for(self._pump(proc, onOutput), timeout)
+                return await proc.wait()
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                self._kill(proc)
+                await proc.wait()
+                raise
+            finally:
+                self._procs.discard(proc)
+        finally:
+            self._semaphore.release()
+
+    async def output(self, cmd, shell: bool=False, timeout: float=None, cwd: str=None):
+        """Runs a command and returns (returncode, output) with the output stripped."""
+        chunks = []
+        async def collect(text):
+            chunks.append(text)
+        returncode = await self.run(cmd, shell=shell, timeout=timeout, onOutput=collect, cwd=cwd)
+        return returncode, "".join(chunks).strip()
+
+    def cancelAll(self):
+        """Kills all running commands. Returns the number of commands killed."""
+        procs = list(self._procs)
+        for proc in procs:
+            self._kill(proc)
+        return len(procs)
+
+    def terminateAll(self):
+        """
+        Asks all running commands to exit (SIGTERM), so that they can clean up after themselves, e.g. git's lock files.
+        Returns the number of commands signalled.
+        """
+        procs = list(self._procs)
+        for proc in procs:
+            self._kill(proc, terminate=True)
+        return len(procs)
+
+    async def _pump(self, proc, onOutput):
+        loop = asyncio.get_running_loop()
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        buf = ""
+        lastFlush = loop.time()
+        while True:
+            try:
+                data = await asyncio.wait_for(proc.stdout.read(4096), self._flushInterval)
+            except asyncio.TimeoutError:
+                data = None # Nothing new; flush whatever we have
+            if data == b"":
+                buf += decoder.decode(b"", final=True)
+                break
+            if data:
+                buf += decoder.decode(data)
+
+            stale = data is None or loop.time() - lastFlush >= self._flushInterval
+            if buf and (stale or len(buf) >= self._chunkSize):
+                buf = await self._flush(buf, onOutput, partial=not stale)
+                lastFlush = loop.time()
+
+        if buf:
+            await self._flush(buf, onOutput, partial=False)
+
+    async def _flush(self, buf: str, onOutput, partial: bool):
+        # When flushing because a chunk is full, only whole chunks are sent and the remainder is kept
+        while len(buf) >= self._chunkSize or (buf and not partial):
+            chunk, buf = buf[:self._chunkSize], buf[self._chunkSize:]
+            if onOutput is not None:
+                await onOutput(chunk)
+        return buf
+
+    @staticmethod
+    def _kill(proc, terminate: bool=False):
+        if proc.returncode is not None:
+            return
+        try:
+            if os.name == 'posix':
+                os.killpg(proc.pid, signal.SIGTERM if terminate else signal.SIGKILL)
+            elif terminate:
+                proc.terminate()
+            else:
+                proc.kill()
+        except ProcessLookupError:
+            pass
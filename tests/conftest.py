@@ -0,0 +1,5 @@
+# The tests import the modules directly, as when running them as scripts from the repository's folder
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,45 @@
+#%% Smoke test of the offline load test: a few hundred updates through a bot against the FakeBotApi.
+import asyncio
+import re
+
+from load_test import runLoadTest, LoadTestBot, UpdateGenerator, ADMIN_ID
+from outbound import OutboundQueue
+
+UPDATES = 300
+CHATS = 20
+
+class SmokeTestBot(LoadTestBot):
+    """Replies are not coalesced, so that every reply is one sendMessage."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._outbox = OutboundQueue(self._app.bot, globalRate=1e9, globalBurst=1e9, chatRate=1e9, chatBurst=1e9,
+                                     coalesce=False, metrics=self._metrics)
+
+def expectedCounts():
+    """Counts of the kinds of update runLoadTest() sends, from the same generator and seed."""
+    updates = UpdateGenerator(chats=CHATS).generate(UPDATES, 0.0)
+    fresh = 1 # Dates of fresh updates are the start time + 1, and of stale ones an hour before that
+    messages = [u["message"] for u in updates]
+    status = sum(1 for m in messages if m["text"] == "/status" and m["date"] == fresh)
+    stale = sum(1 for m in messages if m["date"] < fresh)
+    admin = sum(1 for m in messages if m["text"] == "/admin" and m["from"]["id"] == ADMIN_ID)
+    return status, stale, admin
+
+def handlerCount(report: str, command: str):
+    match = re.search(r"^/%s handler: n=(\d+)," % command, report, re.MULTILINE)
+    return int(match.group(1)) if match is not None else 0
+
+def test_runLoadTest():
+    status, stale, admin = expectedCounts()
+    assert status > 0 and stale > 0 and admin > 0
+
+    results = asyncio.run(runLoadTest(updates=UPDATES, chats=CHATS, botClass=SmokeTestBot))
+
+    assert results["updates"] == UPDATES
+    assert results["updatesPerSecond"] > 0
+    assert 0 < results["p50"] <= results["p99"]
+    # One reply to every fresh /status and to the admin's /admin; none to anything else
+    assert results["repliesSent"] == status + admin
+    # Stale /status commands are dropped by the filters, before the handler
+    assert handlerCount(results["commands"], "status") == status
+    assert handlerCount(results["commands"], "admin") == admin
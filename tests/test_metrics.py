@@ -0,0 +1,18 @@
+#%% Tests of the latency histograms behind /metrics.
+import pytest
+
+from metrics import Histogram
+
+def test_rateBeyondRecentSamples():
+    """More samples than are kept still give the real rate, rather than at most 'recent' per window."""
+    h = Histogram(recent=1000)
+    for i in range(1170):
+        h.observe(0.001, now=100.0 + i * 1.5 / 1170)
+    assert h.rate(60.0, now=101.5) * 60 == pytest.approx(1170 / 1.5 * 60, rel=0.01)
+
+def test_rateWithinWindow():
+    h = Histogram(recent=1000)
+    for i in range(10):
+        h.observe(0.001, now=100.0 + i)
+    assert h.rate(60.0, now=110.0) * 60 == pytest.approx(10.0)
+    assert h.rate(5.0, now=110.0) * 60 == pytest.approx(60.0)
@@ -0,0 +1,31 @@
+#%% Tests of the outbound queue's shutdown.
+import asyncio
+
+import pytest
+
+from outbound import OutboundQueue, QueueStopped
+
+class SlowBot:
+    """Takes a long time over every send."""
+    def __init__(self):
+        self.started = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.started += 1
+        await asyncio.sleep(60)
+
+def test_stopFailsAbandonedMessages():
+    async def main():
+        bot = SlowBot()
+        queue = OutboundQueue(bot, coalesce=False)
+        inFlight = queue.send(1, "first")
+        queued = queue.send(1, "second") # Waits for the first, as sends to a chat are one at a time
+        await asyncio.sleep(0.1)
+        assert bot.started == 1
+        await asyncio.wait_for(queue.stop(), 1.0)
+        for future in (inFlight, queued):
+            with pytest.raises(QueueStopped):
+                await asyncio.wait_for(future, 1.0)
+        assert queue.pending == 0 and not queue._sends
+
+    asyncio.run(main())
@@ -0,0 +1,35 @@
+#%% Tests of the @cached decorator for async methods.
+import asyncio
+
+from response_cache import cached
+
+class Source:
+    def __init__(self, results: list):
+        self.results = results
+        self.calls = 0
+
+    @cached(ttl=60.0, cacheIf=lambda result: result[0] == 0)
+    async def fetch(self):
+        self.calls += 1
+        await asyncio.sleep(0.1)
+        return self.results[self.calls - 1]
+
+def test_cancelledFirstCaller():
+    """Cancelling the caller which started the shared call leaves the other callers with its result."""
+    async def main():
+        source = Source([(0, "ok")])
+        first = asyncio.ensure_future(source.fetch())
+        await asyncio.sleep(0.01)
+        second = asyncio.ensure_future(source.fetch())
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second, first.cancelled(), source.calls
+
+    assert asyncio.run(main()) == ((0, "ok"), True, 1)
+
+def test_cacheIf():
+    async def main():
+        source = Source([(1, "failed"), (0, "ok"), (0, "not called")])
+        return [await source.fetch() for _ in range(3)], source.calls
+
+    assert asyncio.run(main()) == ([(1, "failed"), (0, "ok"), (0, "ok")], 2)
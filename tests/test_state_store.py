@@ -0,0 +1,41 @@
+#%% Tests of the StateStore's cache and write-behind.
+import asyncio
+import time
+
+from state_store import StateStore
+
+def test_setDuringLoad(tmp_path):
+    """A value set while a get() is reading the database, and then flushed, must not be hidden by that read."""
+    store = StateStore(str(tmp_path / "state.db"), flushInterval=1000.0)
+    load = store._load
+    def slowLoad(k):
+        time.sleep(0.2)
+        return load(k)
+    store._load = slowLoad
+
+    async def main():
+        getting = asyncio.ensure_future(store.get(1, "k"))
+        await asyncio.sleep(0.05) # The read is now on the store's thread
+        store.set(1, "k", "v")
+        flushing = asyncio.ensure_future(store.flush()) # Queued behind the read, with the value in _flushing
+        racing = await getting
+        await flushing
+        later = await store.get(1, "k")
+        await store.close()
+        return racing, later
+
+    assert asyncio.run(main()) == ("v", "v")
+
+def test_cacheSize(tmp_path):
+    """Values found pending a write are put back in the cache without growing it past its size."""
+    store = StateStore(str(tmp_path / "state.db"), cacheSize=3, flushInterval=1000.0)
+
+    async def main():
+        for i in range(10):
+            store.set(1, str(i), i)
+        values = [await store.get(1, str(i)) for i in range(10)]
+        cached = store.cached
+        await store.close()
+        return values, cached
+
+    assert asyncio.run(main()) == (list(range(10)), 3)
@@ -0,0 +1,141 @@
+#%% Tuned HTTP transport for the Bot API.
+# By default every application gets python-telegram-bot's default requests, with short timeouts and a pool per bot.
+# A Transport instead builds the application's two requests from one set of settings:
+#   - one for sends and every other call, with a pool of poolSize connections, kept alive between bursts,
+#   - one for getUpdates alone, so that a long poll never holds a connection that a send is waiting for.
+# HTTP/2 is used for the sends if the h2 package is installed (pip install httpx[http2]), since it multiplexes
+# many concurrent requests over one connection.
+#
+# Pass the same Transport to several containers in one process to share its send pool between them:
+#
+#   transport = Transport(poolSize=64)
+#   a = MyBot.fromEnvVar("TOKEN_A", transport=transport)
+#   b = OtherBot.fromEnvVar("TOKEN_B", transport=transport)
+#
+# Each container still gets its own getUpdates connection. The shared pool is closed when the last bot using it shuts down.
+
+import importlib.util
+import logging
+
+import httpx
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+def http2Available():
+    return importlib.util.find_spec("h2") is not None
+
+
+class _TunedHTTPXRequest(HTTPXRequest):
+    """An HTTPXRequest whose client takes the Transport's keep-alive settings, and may be shared through it."""
+    def __init__(self, transport, shared: bool, **kwargs):
+        self._transport = transport
+        self._shared = shared
+        self._holding = False # Whether this request counts as a user of the shared client
+        super().__init__(**kwargs)
+
+    def _build_client(self):
+        if self._shared:
+            self._holding = True
+            return self._transport._acquire(self._client_kwargs)
+        return self._transport._newClient(self._client_kwargs)
+
+    async def initialize(self):
+        if self._shared and not self._holding:
+            # Shut down earlier, while the shared client stayed open for other bots; use it again
+            self._client = self._build_client()
+        await super().initialize()
+
+    async def shutdown(self):
+        if not self._shared:
+            await super().shutdown()
+        elif self._holding:
+            self._holding = False
+            await self._transport._release(self._client)
+
+
+class Transport:
+    """HTTP settings for the Bot API requests of one or more containers, with a send pool shared between them."""
+    def __init__(self, poolSize: int=256, http2: bool=True, connectTimeout: float=5.0, readTimeout: float=10.0,
+                 writeTimeout: float=10.0, poolTimeout: float=2.0, keepAlive: float=30.0, updatesPoolSize: int=1,
+                 proxy: str=None):
+        """
+        Parameters
+        ----------
+        poolSize : int
+            Maximum number of connections for sends and other calls.
+        http2 : bool
+            Use HTTP/2 for sends and other calls, if the h2 package is installed.
+        connectTimeout, readTimeout, writeTimeout, poolTimeout : float
+            Seconds to wait for a connection, a response, a request to be sent, and a free connection in the pool.
+            For getUpdates, the read timeout is extended by the long-poll timeout.
+        keepAlive : float
+            Seconds an idle connection is kept open for reuse.
+        updatesPoolSize : int
+            Maximum number of connections for getUpdates, for each container.
+        proxy : str
+            Proxy URL for all requests, e.g. "socks5://127.0.0.1:1080". Defaults to None, for no proxy.
+        """
+        self.poolSize = poolSize
+        self.http2 = http2 and http2Available()
+        if http2 and not self.http2:
+            logger.info("h2 is not installed, so the Bot API will be used over HTTP/1.1")
+        self.connectTimeout = connectTimeout
+        self.readTimeout = readTimeout
+        self.writeTimeout = writeTimeout
+        self.poolTimeout = poolTimeout
+        self.keepAlive = keepAlive
+        self.updatesPoolSize = updatesPoolSize
+        self.proxy = proxy
+        self._client = None # The shared send client
+        self._users = 0 # Requests currently using it
+
+    @property
+    def users(self):
+        return self._users
+
+    def requests(self):
+        """Makes a (request, getUpdatesRequest) pair for one application."""
+        request = _TunedHTTPXRequest(self, True, http_version="2" if self.http2 else "1.1", **self._kwargs(self.poolSize))
+        updatesRequest = _TunedHTTPXRequest(self, False, http_version="1.1", **self._kwargs(self.updatesPoolSize))
+        return request, updatesRequest
+
+    def apply(self, builder):
+        """Sets the requests of an ApplicationBuilder, and returns it."""
+        request, updatesRequest = self.requests()
+        return builder.request(request).get_updates_request(updatesRequest)
+
+    def _kwargs(self, poolSize: int):
+        kwargs = dict(connection_pool_size=poolSize, connect_timeout=self.connectTimeout, read_timeout=self.readTimeout,
+                      write_timeout=self.writeTimeout, pool_timeout=self.poolTimeout)
+        if self.proxy is not None:
+            kwargs["proxy"] = self.proxy
+        return kwargs
+
+    def _newClient(self, clientKwargs: dict):
+        limits = clientKwargs.get("limits")
+        if limits is not None:
+            clientKwargs = dict(clientKwargs, limits=httpx.Limits(
+                max_connections=limits.max_connections,
+                max_keepalive_connections=limits.max_keepalive_connections,
+                keepalive_expiry=self.keepAlive,
+            ))
+        return httpx.AsyncClient(**clientKwargs)
+
+    def _acquire(self, clientKwargs: dict):
+        if self._client is None or self._client.is_closed:
+            self._client = self._newClient(clientKwargs)
+            self._users = 0
+        self._users += 1
+        return self._client
+
+    async def _release(self, client):
+        if client is not self._client:
+            # From before the shared client was replaced
+            await client.aclose()
+            return
+        self._users -= 1
+        if self._users <= 0:
+            await client.aclose()
+            self._client = None
+            self._users = 0